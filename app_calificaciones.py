@@ -4,10 +4,28 @@ import requests
 import csv
 import time
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import hashlib
+import json
+import sqlite3
+import random
+import threading
+import asyncio
+import bisect
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 from supabase import create_client, Client
 import urllib3
+from requests.adapters import HTTPAdapter
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 # Suprimir warnings de SSL (basado en script verificado)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -37,6 +55,59 @@ except:
 
 HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
 
+def obtener_config(clave, defecto=None):
+    """Lee un valor de configuración con prioridad: Streamlit secrets > variables de entorno"""
+    try:
+        return st.secrets.get(clave, os.getenv(clave, defecto))
+    except Exception:
+        return os.getenv(clave, defecto)
+
+# Espera máxima (segundos) y reintentos al escribir en los caches SQLite compartidos entre sesiones
+SQLITE_BUSY_TIMEOUT = float(obtener_config('SQLITE_BUSY_TIMEOUT', 30))
+SQLITE_REINTENTOS = int(obtener_config('SQLITE_REINTENTOS', 5))
+
+# Pool de conexiones HTTP hacia Moodle
+MOODLE_POOL_SIZE = int(obtener_config('MOODLE_POOL_SIZE', 20))
+MOODLE_CONNECT_TIMEOUT = float(obtener_config('MOODLE_CONNECT_TIMEOUT', 10))
+MOODLE_READ_TIMEOUT = float(obtener_config('MOODLE_READ_TIMEOUT', 60))
+
+# Máximo de consultas de feedback simultáneas por actividad
+FEEDBACK_MAX_WORKERS = int(obtener_config('FEEDBACK_MAX_WORKERS', 8))
+
+# Máximo de consultas simultáneas a Moodle durante una extracción masiva
+MASIVO_MAX_CONCURRENCIA = int(obtener_config('MASIVO_MAX_CONCURRENCIA', 16))
+
+# Actividades por cada llamada a mod_assign_get_grades
+GRADES_TAMANO_LOTE = int(obtener_config('GRADES_TAMANO_LOTE', 20))
+
+# Actividades por cada llamada a mod_assign_get_submissions
+SUBMISSIONS_TAMANO_LOTE = int(obtener_config('SUBMISSIONS_TAMANO_LOTE', 20))
+
+# Cursos por cada llamada a mod_assign_get_assignments
+ASSIGNMENTS_TAMANO_LOTE = int(obtener_config('ASSIGNMENTS_TAMANO_LOTE', 25))
+
+# Segundos que se conserva en memoria el índice de assignments de cada curso
+ASSIGNMENTS_INDICE_TTL = int(obtener_config('ASSIGNMENTS_INDICE_TTL', 3600))
+
+# Segundos que se reutiliza el estado de entrega (feedback + fechas) de un estudiante
+SUBMISSION_STATUS_TTL = int(obtener_config('SUBMISSION_STATUS_TTL', 900))
+# Máximo de estados de entrega conservados en memoria
+SUBMISSION_STATUS_MAX = int(obtener_config('SUBMISSION_STATUS_MAX', 200000))
+
+# Segundos que se reutiliza la lista de participantes de un curso
+ROSTER_TTL = int(obtener_config('ROSTER_TTL', 1800))
+
+# Limitador de velocidad adaptativo, reintentos y cortocircuito hacia Moodle
+MOODLE_RATE_INICIAL = float(obtener_config('MOODLE_RATE_INICIAL', 10))   # consultas/segundo
+MOODLE_RATE_MIN = float(obtener_config('MOODLE_RATE_MIN', 1))
+MOODLE_RATE_MAX = float(obtener_config('MOODLE_RATE_MAX', 50))
+MOODLE_LATENCIA_OBJETIVO = float(obtener_config('MOODLE_LATENCIA_OBJETIVO', 2))  # segundos
+MOODLE_MAX_REINTENTOS = int(obtener_config('MOODLE_MAX_REINTENTOS', 4))
+MOODLE_BACKOFF_BASE = float(obtener_config('MOODLE_BACKOFF_BASE', 0.5))
+MOODLE_BACKOFF_MAX = float(obtener_config('MOODLE_BACKOFF_MAX', 30))
+MOODLE_CIRCUITO_UMBRAL = int(obtener_config('MOODLE_CIRCUITO_UMBRAL', 5))   # fallos consecutivos
+MOODLE_CIRCUITO_PAUSA = float(obtener_config('MOODLE_CIRCUITO_PAUSA', 30))  # segundos
+
 # Inicializar cliente Supabase solo si las credenciales están disponibles
 supabase: Client = None
 if SUPABASE_URL and SUPABASE_KEY:
@@ -49,86 +120,418 @@ if SUPABASE_URL and SUPABASE_KEY:
 # Archivos de datos
 ASIGNACIONES_CSV = "asignaciones_evaluaciones.csv"
 CURSOS_CSV = "cursos.csv"
-CACHE_CSV = "cache_calificaciones.csv"
-CACHE_MASIVO_CSV = "cache_masivo.csv"
+CACHE_WS_DB = "cache_ws.db"
+CACHE_DB = "cache_calificaciones.db"
+CACHE_PARQUET_DIR = "cache_parquet"
+
+# Formato del cache local: "sqlite" (por defecto) o "parquet" (columnar, requiere pyarrow)
+CACHE_BACKEND = str(obtener_config('CACHE_BACKEND', 'sqlite')).lower()
+
+# Política del cache local: vigencia, presupuesto de registros (LRU) y stale-while-revalidate
+CACHE_ENABLED = str(obtener_config('CACHE_ENABLED', 'true')).lower() == 'true'
+CACHE_EXPIRY_HOURS = float(obtener_config('CACHE_EXPIRY_HOURS', 24))
+CACHE_MAX_REGISTROS = int(obtener_config('CACHE_MAX_REGISTROS', 500000))
+CACHE_SERVIR_VENCIDO = str(obtener_config('CACHE_SERVIR_VENCIDO', 'false')).lower() == 'true'
+
+# Métricas de latencia por nivel de cache y wsfunction (se guardan en CACHE_DB)
+METRICAS_HABILITADAS = str(obtener_config('METRICAS_HABILITADAS', 'true')).lower() == 'true'
+METRICAS_INTERVALO_VOLCADO = float(obtener_config('METRICAS_INTERVALO_VOLCADO', 60))  # segundos
+CUBETAS_LATENCIA = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # segundos
+
+# Cache en disco de respuestas de Moodle
+WS_CACHE_ENABLED = str(obtener_config('WS_CACHE_ENABLED', 'true')).lower() == 'true'
+WS_CACHE_MAX_MB = float(obtener_config('WS_CACHE_MAX_MB', 200))
+# Segundos de vigencia por función; las funciones no listadas no se guardan
+WS_CACHE_TTL = {
+    "mod_assign_get_assignments": 86400,
+    "mod_assign_list_participants": 3600,
+    "core_enrol_get_enrolled_users": 3600,
+    "core_course_get_contents": 3600,
+    "mod_assign_get_grades": 900,
+    "mod_assign_get_submissions": 900,
+    "mod_assign_get_submission_status": 900,
+}
+
+# Sincronización incremental de calificaciones (parámetro since de mod_assign_get_grades)
+SYNC_INCREMENTAL = str(obtener_config('SYNC_INCREMENTAL', 'true')).lower() == 'true'
+# La marca se retrasa lo que una respuesta puede llevar en cache, más un margen por desfase de relojes
+SYNC_MARGEN_SEGUNDOS = WS_CACHE_TTL.get("mod_assign_get_grades", 0) + 300
+
+# Detección de cambios por curso (core_course_get_updates_since) antes de sincronizar
+DETECCION_CAMBIOS = str(obtener_config('DETECCION_CAMBIOS', 'true')).lower() == 'true'
+# Solo compensa consultar un curso si tiene al menos estas actividades por sincronizar
+DETECCION_MIN_ACTIVIDADES = int(obtener_config('DETECCION_MIN_ACTIVIDADES', 2))
+
+# Lecturas paginadas de Supabase: filas por página (si supera el max-rows del servidor, 1000 por
+# defecto en Supabase, cada página llega recortada a ese límite) y particiones de una misma
+# lectura que se consultan en paralelo
+SUPABASE_TAMANO_PAGINA = int(obtener_config('SUPABASE_TAMANO_PAGINA', 1000))
+SUPABASE_LECTORES = int(obtener_config('SUPABASE_LECTORES', 4))
+# Segundos que se reutilizan los valores de los filtros de la búsqueda avanzada
+SUPABASE_FILTROS_TTL = int(obtener_config('SUPABASE_FILTROS_TTL', 600))
+# Valores máximos de un filtro in_ por consulta, para no exceder el largo de la URL
+SUPABASE_MAX_VALORES_IN = 200
+# Escrituras en Supabase: registros por upsert, upserts simultáneos y reintentos por lote
+SUPABASE_TAMANO_LOTE = int(obtener_config('SUPABASE_TAMANO_LOTE', 500))
+SUPABASE_ESCRITORES = int(obtener_config('SUPABASE_ESCRITORES', 4))
+SUPABASE_REINTENTOS = int(obtener_config('SUPABASE_REINTENTOS', 3))
+SUPABASE_BACKOFF_BASE = float(obtener_config('SUPABASE_BACKOFF_BASE', 1))
+# Columnas de calificaciones_feedback que usa la aplicación (id se necesita para paginar)
+COLUMNAS_SUPABASE = [
+    'id', 'course_id', 'assignment_id', 'course_name', 'assignment_name', 'docente',
+    'user_id', 'user_fullname', 'grade', 'feedback', 'has_feedback'
+]
+
+# Casos especiales: opción de la pestaña -> valor de la columna caso en la vista casos_especiales
+CASOS_ESPECIALES = {
+    "Calificación 16-18 sin feedback": "nota_16_18_sin_feedback",
+    "Calificación 14-15 sin feedback": "nota_14_15_sin_feedback",
+    "Calificación 1-13 sin feedback": "nota_1_13_sin_feedback",
+    "Sin calificación en actividades específicas": "sin_calificacion",
+}
+# Regla única de los casos (pandas, vista SQLite y vista de Supabase en el README): una nota
+# que no es un número sin signo (vacía, '-', el '-1.00000' de Moodle) o que vale 0 es
+# sin_calificacion; si no, sin feedback y dentro de un rango (inclusive) es ese caso
+PATRON_NOTA = r'[0-9]+(\.[0-9]+)?'
+RANGOS_CASOS = {
+    "nota_16_18_sin_feedback": (16, 18),
+    "nota_14_15_sin_feedback": (14, 15),
+    "nota_1_13_sin_feedback": (1, 13),
+}
+COLUMNAS_CASOS = [
+    'course_id', 'assignment_id', 'course_name', 'assignment_name', 'docente',
+    'user_id', 'user_fullname', 'grade', 'has_feedback'
+]
 
 # ==========================
 # FUNCIONES SUPABASE
 # ==========================
-def verificar_datos_en_supabase(course_id, assignment_id):
-    """Verifica si ya existen datos en Supabase para un curso y actividad específicos"""
+def _proyeccion_supabase(columnas):
+    """Convierte una lista de columnas en el select de PostgREST, incluyendo siempre id"""
+    if columnas is None:
+        columnas = COLUMNAS_SUPABASE
+    if columnas == '*':
+        return '*'
+    return ','.join(['id'] + [c for c in columnas if c != 'id'])
+
+def _consultar_pagina_supabase(proyeccion, filtros, desde_id, tamano_pagina, tabla='calificaciones_feedback'):
+    """Consulta una página de la tabla (o vista) ordenada por id a partir de desde_id (keyset)"""
+    query = supabase.table(tabla).select(proyeccion)
+    for operador, columna, valor in filtros:
+        query = getattr(query, operador)(columna, valor)
+    if desde_id is not None:
+        query = query.gt('id', desde_id)
+    with medir("supabase_pagina_segundos"):
+        return query.order('id').limit(tamano_pagina).execute().data
+
+def iterar_paginas_supabase(filtros=(), columnas=None, tamano_pagina=SUPABASE_TAMANO_PAGINA, tabla='calificaciones_feedback'):
+    """Genera las filas de calificaciones_feedback (o de una vista con id) página a página.
+    
+    filtros es una lista de tuplas (operador, columna, valor) del query builder, por
+    ejemplo ('in_', 'course_id', [...]) o ('eq', 'docente', ...). Usa paginación keyset
+    sobre id y pide la página siguiente mientras el consumidor procesa la actual. Termina con
+    la primera página vacía: una página corta no indica el final si max-rows la recortó.
+    """
+    proyeccion = _proyeccion_supabase(columnas)
+    filtros = list(filtros)
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        siguiente = prefetch.submit(_consultar_pagina_supabase, proyeccion, filtros, None, tamano_pagina, tabla)
+        while True:
+            filas = siguiente.result()
+            if not filas:
+                break
+            siguiente = prefetch.submit(
+                _consultar_pagina_supabase, proyeccion, filtros, filas[-1]['id'], tamano_pagina, tabla
+            )
+            yield filas
+
+def _particionar_filtros(filtros, partes, max_valores=SUPABASE_MAX_VALORES_IN):
+    """Reparte los valores del filtro in_ más largo en lecturas independientes.
+    
+    Genera al menos `partes` lecturas y ninguna con más de max_valores valores.
+    """
+    candidatos = [i for i, (operador, _, valor) in enumerate(filtros) if operador == 'in_' and len(valor) > 1]
+    if not candidatos:
+        return [filtros]
+    i = max(candidatos, key=lambda j: len(filtros[j][2]))
+    operador, columna, valores = filtros[i][0], filtros[i][1], list(filtros[i][2])
+    tamano = min(max(1, max_valores), -(-len(valores) // max(1, partes)))
+    return [
+        filtros[:i] + [(operador, columna, valores[j:j + tamano])] + filtros[i + 1:]
+        for j in range(0, len(valores), tamano)
+    ]
+
+def leer_supabase_paginado(filtros=(), columnas=None, tamano_pagina=SUPABASE_TAMANO_PAGINA, lectores=SUPABASE_LECTORES,
+                           tabla='calificaciones_feedback'):
+    """Lee de calificaciones_feedback todas las filas que cumplan los filtros, sin el corte de max-rows.
+    
+    Si hay un filtro in_, sus valores se reparten entre varios lectores que paginan en
+    paralelo. El DataFrame se arma por bloques a medida que llegan las páginas.
+    """
+    particiones = _particionar_filtros(list(filtros), lectores)
+    bloques = []
+    
+    def leer_particion(filtros_particion):
+        return [
+            pd.DataFrame(filas)
+            for filas in iterar_paginas_supabase(filtros_particion, columnas, tamano_pagina, tabla)
+        ]
+    
+    if len(particiones) == 1:
+        bloques = leer_particion(particiones[0])
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, min(lectores, len(particiones)))) as executor:
+            futuros = [executor.submit(leer_particion, particion) for particion in particiones]
+            for futuro in as_completed(futuros):
+                bloques.extend(futuro.result())
+    
+    if not bloques:
+        return pd.DataFrame()
+    return pd.concat(bloques, ignore_index=True)
+
+@st.cache_data(ttl=SUPABASE_FILTROS_TTL, show_spinner="Cargando filtros de búsqueda...")
+def obtener_valores_filtros_supabase() -> dict:
+    """Valores distintos de course_name, docente y user_fullname para los filtros de búsqueda.
+    
+    Streamlit ejecuta todas las pestañas en cada rerun, así que se guardan SUPABASE_FILTROS_TTL
+    segundos en vez de recorrer la tabla completa con cada clic.
+    """
+    columnas = ['course_name', 'docente', 'user_fullname']
+    df = leer_supabase_paginado(columnas=columnas)
+    return {
+        columna: sorted(df[columna].dropna().unique().tolist()) if columna in df else []
+        for columna in columnas
+    }
+
+def contar_supabase(filtros=(), tabla='calificaciones_feedback'):
+    """Cuenta las filas que cumplen los filtros sin descargarlas (HEAD con conteo por partición)"""
+    total = 0
+    for particion in _particionar_filtros(list(filtros), 1):
+        query = supabase.table(tabla).select('id', count='exact', head=True)
+        for operador, columna, valor in particion:
+            query = getattr(query, operador)(columna, valor)
+        total += query.execute().count or 0
+    return total
+
+def resumen_casos_supabase(caso, assignment_ids, tamano_pagina=SUPABASE_TAMANO_PAGINA):
+    """Casos por estudiante calculados en Supabase con la función resumen_casos_especiales.
+    
+    La función pagina por user_fullname (p_despues/p_limite) para no quedar cortada en max-rows;
+    se sigue pidiendo hasta recibir una página vacía.
+    """
+    filas = []
+    despues = ''
+    while True:
+        with medir("supabase_pagina_segundos", tabla="resumen_casos_especiales"):
+            pagina = supabase.rpc('resumen_casos_especiales', {
+                'p_caso': caso,
+                'p_assignment_ids': [int(a) for a in assignment_ids],
+                'p_despues': despues,
+                'p_limite': tamano_pagina
+            }).execute().data
+        if not pagina:
+            break
+        filas.extend(pagina)
+        despues = pagina[-1]['user_fullname']
+    return pd.DataFrame(filas, columns=['user_fullname', 'course_name', 'docente', 'casos'])
+
+def consultar_actividad_supabase(course_id, assignment_id, columnas=None):
+    """Busca los datos de un curso y actividad en Supabase con una sola consulta.
+    
+    Retorna (existe, df) con las columnas indicadas (por defecto COLUMNAS_SUPABASE).
+    """
     if not supabase:
-        return False, []
+        return False, pd.DataFrame()
     try:
-        response = supabase.table('calificaciones_feedback').select('*').eq('course_id', course_id).eq('assignment_id', assignment_id).execute()
-        return len(response.data) > 0, response.data
+        df = leer_supabase_paginado(
+            [('eq', 'course_id', course_id), ('eq', 'assignment_id', assignment_id)], columnas
+        )
+        return not df.empty, df
     except Exception as e:
         st.warning(f"Error al consultar Supabase: {str(e)}")
-        return False, []
+        return False, pd.DataFrame()
 
-def guardar_datos_en_supabase(datos_lista):
-    """Guarda una lista de datos en Supabase"""
-    if not supabase:
-        return False, 0
-    try:
-        # Preparar datos para inserción
-        datos_para_insertar = []
-        for dato in datos_lista:
-            registro = {
-                'course_id': dato.get('course_id'),
-                'assignment_id': dato.get('assignment_id'),
-                'course_name': dato.get('course_name'),
-                'assignment_name': dato.get('assignment_name'),
-                'docente': dato.get('docente'),
-                'user_id': dato.get('user_id'),
-                'user_fullname': dato.get('user_fullname'),
-                'grade': str(dato.get('grade', '')),
-                'feedback': dato.get('feedback', ''),
-                'has_feedback': dato.get('has_feedback', False)
-            }
-            datos_para_insertar.append(registro)
-        
-        # Insertar en Supabase usando upsert para evitar duplicados
-        response = supabase.table('calificaciones_feedback').upsert(
-            datos_para_insertar,
-            on_conflict='course_id,assignment_id,user_id'
-        ).execute()
+def _registro_supabase(dato):
+    """Prepara un registro extraído para insertarlo en calificaciones_feedback"""
+    registro = {
+        'course_id': dato.get('course_id'),
+        'assignment_id': dato.get('assignment_id'),
+        'course_name': dato.get('course_name'),
+        'assignment_name': dato.get('assignment_name'),
+        'docente': dato.get('docente'),
+        'user_id': dato.get('user_id'),
+        'user_fullname': dato.get('user_fullname'),
+        'grade': str(dato.get('grade', '')),
+    }
+    # Sin feedback consultado no se envían esas columnas: las filas nuevas quedan con feedback
+    # NULL (fuera de casos_especiales) y el upsert no pisa un feedback ya guardado
+    if 'has_feedback' in dato:
+        registro['feedback'] = dato.get('feedback', '')
+        registro['has_feedback'] = dato['has_feedback']
+    return registro
+
+class EscritorSupabase:
+    """Sube registros a Supabase en lotes de upsert paralelos mientras se siguen agregando.
+    
+    agregar() no bloquea: cada vez que se juntan tamano_lote registros se envía un lote a
+    uno de los escritores. Un lote fallido se reintenta con backoff exponencial y jitter.
+    cerrar() envía el resto, espera todos los lotes y retorna (exito, registros, reporte),
+    con una entrada por lote: {'lote', 'registros', 'intentos', 'exito', 'error'}.
+    preparar convierte cada dato en el registro a enviar (por defecto _registro_supabase).
+    No usa st.*, así que se puede alimentar desde cualquier hilo.
+    """
+    
+    def __init__(self, tamano_lote=SUPABASE_TAMANO_LOTE, escritores=SUPABASE_ESCRITORES,
+                 reintentos=SUPABASE_REINTENTOS, backoff_base=SUPABASE_BACKOFF_BASE, preparar=_registro_supabase):
+        self.tamano_lote = max(1, tamano_lote)
+        self.preparar = preparar
+        self.reintentos = reintentos
+        self.backoff_base = backoff_base
+        self._pendientes = []
+        self._futuros = []
+        self._resultado = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, escritores)) if supabase else None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.cerrar()
+    
+    def agregar(self, datos):
+        """Encola registros y envía los lotes que ya estén completos"""
+        if not self._executor:
+            return
+        with self._lock:
+            self._pendientes.extend(self.preparar(dato) for dato in datos)
+            while len(self._pendientes) >= self.tamano_lote:
+                self._enviar(self._pendientes[:self.tamano_lote])
+                del self._pendientes[:self.tamano_lote]
+    
+    def cerrar(self):
+        """Envía los registros restantes, espera todos los lotes y retorna (exito, registros, reporte)"""
+        with self._lock:
+            if self._resultado is not None:
+                return self._resultado
+            if not self._executor:
+                self._resultado = (False, 0, [])
+                return self._resultado
+            if self._pendientes:
+                self._enviar(self._pendientes)
+                self._pendientes = []
         
-        return True, len(response.data)
-    except Exception as e:
-        st.error(f"Error al guardar en Supabase: {str(e)}")
+        reporte = [futuro.result() for futuro in self._futuros]
+        self._executor.shutdown()
+        registros = sum(lote['registros'] for lote in reporte if lote['exito'])
+        exito = bool(reporte) and all(lote['exito'] for lote in reporte)
+        self._resultado = (exito, registros, reporte)
+        return self._resultado
+    
+    def _enviar(self, registros):
+        """Envía un lote al pool de escritores (requiere self._lock)"""
+        self._futuros.append(self._executor.submit(self._subir_lote, len(self._futuros) + 1, list(registros)))
+    
+    def _subir_lote(self, numero, registros):
+        """Hace el upsert de un lote, reintentando ante cualquier error"""
+        error = None
+        for intento in range(self.reintentos + 1):
+            if intento:
+                time.sleep(random.uniform(0, min(MOODLE_BACKOFF_MAX, self.backoff_base * (2 ** intento))))
+            try:
+                with medir("supabase_upsert_segundos"):
+                    # Upsert para evitar duplicados
+                    supabase.table('calificaciones_feedback').upsert(
+                        registros,
+                        on_conflict='course_id,assignment_id,user_id'
+                    ).execute()
+                return {'lote': numero, 'registros': len(registros), 'intentos': intento + 1, 'exito': True, 'error': None}
+            except Exception as e:
+                error = str(e)
+        return {'lote': numero, 'registros': len(registros), 'intentos': self.reintentos + 1, 'exito': False, 'error': error}
+
+def avisar_lotes_fallidos(reporte):
+    """Muestra qué lotes no se pudieron guardar en Supabase tras agotar los reintentos"""
+    fallidos = [lote for lote in reporte if not lote['exito']]
+    if fallidos:
+        sin_guardar = sum(lote['registros'] for lote in fallidos)
+        st.error(
+            f"Error al guardar en Supabase: {len(fallidos)} de {len(reporte)} lotes fallaron "
+            f"({sin_guardar} registros sin guardar). Último error: {fallidos[-1]['error']}"
+        )
+
+def guardar_datos_en_supabase(datos_lista):
+    """Guarda una lista de datos en Supabase en lotes paralelos.
+    
+    Retorna (exito, registros_guardados, reporte por lote).
+    """
+    with EscritorSupabase() as escritor:
+        escritor.agregar(datos_lista)
+    exito, registros, reporte = escritor.cerrar()
+    avisar_lotes_fallidos(reporte)
+    return exito, registros, reporte
+
+def _registro_grade_supabase(dato):
+    """Registro que actualiza la calificación sin enviar (ni pisar) las columnas de feedback"""
+    registro = _registro_supabase({k: v for k, v in dato.items() if k not in ('feedback', 'has_feedback')})
+    registro['updated_at'] = datetime.now(timezone.utc).isoformat()
+    return registro
+
+def actualizar_grades_en_supabase(datos_lista):
+    """Actualiza solo la calificación de registros existentes, sin tocar su feedback.
+    
+    Usa los mismos lotes con reintentos que guardar_datos_en_supabase; retorna (exito, registros).
+    """
+    if not supabase or not datos_lista:
         return False, 0
+    with EscritorSupabase(preparar=_registro_grade_supabase) as escritor:
+        escritor.agregar(datos_lista)
+    exito, registros, reporte = escritor.cerrar()
+    avisar_lotes_fallidos(reporte)
+    return exito, registros
 
-def obtener_datos_de_supabase(course_id, assignment_id):
-    """Obtiene datos específicos de Supabase"""
-    if not supabase:
-        return pd.DataFrame()
-    try:
-        response = supabase.table('calificaciones_feedback').select('*').eq('course_id', course_id).eq('assignment_id', assignment_id).execute()
-        return pd.DataFrame(response.data)
-    except Exception as e:
-        st.error(f"Error al obtener datos de Supabase: {str(e)}")
-        return pd.DataFrame()
+def construir_filtros_supabase(filtros):
+    """Traduce los filtros de una consulta masiva a condiciones del query builder.
+    
+    Claves admitidas: course_ids, actividades (pares (course_id, assignment_id)), docente,
+    course_name y solo_con_feedback. Con actividades se filtra por assignment_id, que es
+    único en Moodle; los pares exactos se comprueban en obtener_datos_masivos_supabase.
+    """
+    filtros_query = []
+    
+    if filtros.get('actividades'):
+        filtros_query.append(('in_', 'assignment_id', sorted({int(a) for _, a in filtros['actividades']})))
+    elif filtros.get('course_ids'):
+        filtros_query.append(('in_', 'course_id', list(filtros['course_ids'])))
+    
+    if filtros.get('docente'):
+        filtros_query.append(('eq', 'docente', filtros['docente']))
+    
+    if filtros.get('course_name'):
+        filtros_query.append(('eq', 'course_name', filtros['course_name']))
+    
+    # feedback <> '' también descarta los NULL
+    if filtros.get('solo_con_feedback'):
+        filtros_query.append(('neq', 'feedback', ''))
+    
+    return filtros_query
 
-def obtener_datos_masivos_supabase(filtros):
-    """Obtiene datos masivos de Supabase con filtros"""
+def obtener_datos_masivos_supabase(filtros, columnas=None):
+    """Obtiene datos masivos de Supabase con filtros, paginando hasta leer todas las filas"""
     if not supabase:
         return pd.DataFrame()
     try:
-        query = supabase.table('calificaciones_feedback').select('*')
-        
-        # Aplicar filtros
-        if 'course_ids' in filtros and filtros['course_ids']:
-            query = query.in_('course_id', filtros['course_ids'])
+        actividades = filtros.get('actividades')
+        if actividades and columnas not in (None, '*'):
+            columnas = list(dict.fromkeys(list(columnas) + ['course_id', 'assignment_id']))
         
-        if 'docente' in filtros and filtros['docente']:
-            query = query.eq('docente', filtros['docente'])
+        df = leer_supabase_paginado(construir_filtros_supabase(filtros), columnas)
         
-        if 'course_name' in filtros and filtros['course_name']:
-            query = query.eq('course_name', filtros['course_name'])
-            
-        response = query.execute()
-        return pd.DataFrame(response.data)
+        if actividades and not df.empty:
+            pares = {(int(c), int(a)) for c, a in actividades}
+            claves = pd.Series(list(zip(df['course_id'].astype(int), df['assignment_id'].astype(int))), index=df.index)
+            df = df[claves.isin(pares)].reset_index(drop=True)
+        return df
     except Exception as e:
         st.error(f"Error al obtener datos masivos de Supabase: {str(e)}")
         return pd.DataFrame()
@@ -147,48 +550,363 @@ def verificar_conexion_supabase():
 # ==========================
 # FUNCIONES AUXILIARES MOODLE
 # ==========================
-def llamar_ws(params: dict) -> dict:
-    """Envía petición POST al endpoint REST de Moodle"""
-    resp = requests.post(MOODLE_BASE_URL, data=params, headers=HEADERS, verify=False)
-    resp.raise_for_status()
-    return resp.json()
+class LimitadorAdaptativo:
+    """Token bucket compartido por todas las llamadas WS.
+    
+    La tasa sube gradualmente mientras Moodle responde rápido, baja a la mitad ante
+    respuestas 429/5xx o latencias altas, y tras varios fallos seguidos abre el
+    circuito: todas las llamadas esperan MOODLE_CIRCUITO_PAUSA segundos.
+    """
+
+    def __init__(self, tasa=MOODLE_RATE_INICIAL, tasa_min=MOODLE_RATE_MIN, tasa_max=MOODLE_RATE_MAX,
+                 latencia_objetivo=MOODLE_LATENCIA_OBJETIVO, umbral_circuito=MOODLE_CIRCUITO_UMBRAL,
+                 pausa_circuito=MOODLE_CIRCUITO_PAUSA):
+        self.tasa = tasa
+        self.tasa_min = tasa_min
+        self.tasa_max = tasa_max
+        self.latencia_objetivo = latencia_objetivo
+        self.umbral_circuito = umbral_circuito
+        self.pausa_circuito = pausa_circuito
+        self.tokens = tasa
+        self.ultima_recarga = time.monotonic()
+        self.fallos_consecutivos = 0
+        self.circuito_abierto_hasta = 0.0
+        self._lock = threading.Lock()
+
+    def adquirir(self):
+        """Bloquea hasta que haya un token disponible y el circuito esté cerrado"""
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                if ahora < self.circuito_abierto_hasta:
+                    espera = self.circuito_abierto_hasta - ahora
+                else:
+                    self.tokens = min(self.tasa, self.tokens + (ahora - self.ultima_recarga) * self.tasa)
+                    self.ultima_recarga = ahora
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    espera = (1 - self.tokens) / self.tasa
+            time.sleep(espera)
+
+    def registrar_exito(self, latencia):
+        with self._lock:
+            self.fallos_consecutivos = 0
+            if latencia > self.latencia_objetivo:
+                self.tasa = max(self.tasa_min, self.tasa * 0.9)
+            else:
+                self.tasa = min(self.tasa_max, self.tasa + 0.5)
+
+    def registrar_sobrecarga(self):
+        """Reduce la tasa; retorna True si con este fallo se abrió el circuito"""
+        with self._lock:
+            self.fallos_consecutivos += 1
+            self.tasa = max(self.tasa_min, self.tasa * 0.5)
+            self.tokens = min(self.tokens, 0)
+            if self.fallos_consecutivos < self.umbral_circuito:
+                return False
+            self.circuito_abierto_hasta = time.monotonic() + self.pausa_circuito
+            self.fallos_consecutivos = 0
+            return True
+
+def _conectar_sqlite(ruta):
+    """Abre una conexión SQLite utilizable desde varios hilos (el acceso se serializa con un lock).
+    
+    WAL permite que otros procesos lean mientras uno escribe; busy_timeout hace esperar a un
+    escritor en vez de fallar de inmediato.
+    """
+    conn = sqlite3.connect(ruta, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+    return conn
+
+@contextmanager
+def transaccion_escritura(conn, reintentos=SQLITE_REINTENTOS):
+    """Transacción que toma el bloqueo de escritura al empezar (BEGIN IMMEDIATE).
+    
+    Así lo leído dentro de la transacción no cambia antes del commit aunque otro proceso
+    escriba en el mismo archivo. Si la base sigue bloqueada tras busy_timeout se reintenta.
+    """
+    for intento in range(reintentos + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or intento == reintentos:
+                raise
+            time.sleep(min(0.1 * 2 ** intento, 2) + random.uniform(0, 0.1))
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+class CacheRespuestasWS:
+    """Cache en disco (SQLite) de respuestas JSON de Moodle.
+    
+    La clave es un hash de wsfunction + parámetros normalizados (sin wstoken). Cada función
+    tiene su propio TTL y, al superar max_mb, se eliminan las entradas usadas hace más tiempo.
+    Las lecturas no toman el bloqueo de escritura: el último acceso de cada entrada se guarda
+    en lote con la siguiente escritura.
+    """
+
+    def __init__(self, ruta=CACHE_WS_DB, ttl_por_funcion=WS_CACHE_TTL, max_mb=WS_CACHE_MAX_MB):
+        self.ttl_por_funcion = ttl_por_funcion
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._accesos = {}
+        self._conn = _conectar_sqlite(ruta)
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS ws_cache (
+                    clave TEXT PRIMARY KEY,
+                    wsfunction TEXT NOT NULL,
+                    respuesta TEXT NOT NULL,
+                    creado REAL NOT NULL,
+                    accedido REAL NOT NULL,
+                    tamano INTEGER NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ws_cache_accedido ON ws_cache(accedido)")
+            self._bytes_totales = self._conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM ws_cache").fetchone()[0]
+
+    @staticmethod
+    def crear_clave(params: dict) -> str:
+        normalizados = sorted((str(k), str(v)) for k, v in params.items() if k != "wstoken")
+        return hashlib.sha256(json.dumps(normalizados).encode()).hexdigest()
+
+    def ttl(self, wsfunction) -> int:
+        return self.ttl_por_funcion.get(wsfunction, 0)
+
+    def obtener(self, params: dict):
+        """Respuesta guardada y vigente, o None"""
+        ttl = self.ttl(params.get("wsfunction"))
+        if ttl <= 0:
+            return None
+        clave = self.crear_clave(params)
+        ahora = time.time()
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT respuesta, creado FROM ws_cache WHERE clave = ?", (clave,)
+            ).fetchone()
+            if fila is None or ahora - fila[1] >= ttl:
+                return None
+            self._accesos[clave] = ahora
+        return json.loads(fila[0])
+
+    def _volcar_accesos(self):
+        """Guarda los últimos accesos pendientes (requiere self._lock y transacción de escritura)"""
+        if self._accesos:
+            self._conn.executemany(
+                "UPDATE ws_cache SET accedido = MAX(accedido, ?) WHERE clave = ?",
+                [(accedido, clave) for clave, accedido in self._accesos.items()]
+            )
+            self._accesos = {}
+
+    def guardar(self, params: dict, respuesta):
+        wsfunction = params.get("wsfunction")
+        # No se guardan funciones sin TTL ni respuestas de error de Moodle
+        if self.ttl(wsfunction) <= 0 or (isinstance(respuesta, dict) and respuesta.get("exception")):
+            return
+        clave = self.crear_clave(params)
+        texto = json.dumps(respuesta)
+        ahora = time.time()
+        with self._lock, transaccion_escritura(self._conn):
+            anterior = self._conn.execute("SELECT tamano FROM ws_cache WHERE clave = ?", (clave,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ws_cache (clave, wsfunction, respuesta, creado, accedido, tamano) VALUES (?, ?, ?, ?, ?, ?)",
+                (clave, wsfunction, texto, ahora, ahora, len(texto))
+            )
+            self._bytes_totales += len(texto) - (anterior[0] if anterior else 0)
+            self._volcar_accesos()
+            if self._bytes_totales > self.max_bytes:
+                self._desalojar()
+
+    def _desalojar(self):
+        """Elimina las entradas menos usadas recientemente hasta quedar en el 90% del límite"""
+        objetivo = self.max_bytes * 0.9
+        # Otros procesos pueden haber escrito en el mismo archivo
+        self._bytes_totales = self._conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM ws_cache").fetchone()[0]
+        for clave, tamano in self._conn.execute("SELECT clave, tamano FROM ws_cache ORDER BY accedido").fetchall():
+            if self._bytes_totales <= objetivo:
+                break
+            self._conn.execute("DELETE FROM ws_cache WHERE clave = ?", (clave,))
+            self._bytes_totales -= tamano
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            entradas = self._conn.execute("SELECT COUNT(*) FROM ws_cache").fetchone()[0]
+        return {"entradas": entradas, "mb": self._bytes_totales / (1024 * 1024)}
+
+    def limpiar(self):
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.execute("DELETE FROM ws_cache")
+            self._bytes_totales = 0
+            self._accesos = {}
+
+# Pausas del circuito abiertas por las llamadas de la extracción en curso (None fuera de una)
+PAUSAS_EXTRACCION = contextvars.ContextVar("pausas_extraccion", default=None)
+
+class ClienteMoodle:
+    """Cliente del endpoint REST de Moodle con sesión keep-alive y pool de conexiones"""
+
+    def __init__(self, base_url, pool_size=MOODLE_POOL_SIZE,
+                 timeout=(MOODLE_CONNECT_TIMEOUT, MOODLE_READ_TIMEOUT),
+                 max_reintentos=MOODLE_MAX_REINTENTOS, cache=None, contadores=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_reintentos = max_reintentos
+        self.cache = cache
+        self.contadores = contadores
+        self.limitador = LimitadorAdaptativo()
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.verify = False
+        # pool_block evita abrir conexiones extra cuando hay más hilos que conexiones en el pool
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def llamar(self, params: dict, usar_cache: bool = True) -> dict:
+        """Consulta Moodle, usando el cache de respuestas salvo que usar_cache sea False.
+        
+        La respuesta nueva siempre se guarda en el cache (si la función tiene TTL).
+        """
+        with medir("moodle_ws_segundos", wsfunction=params.get("wsfunction"), origen="cache") as etiquetas:
+            if self.cache and usar_cache and self.cache.ttl(params.get("wsfunction")) > 0:
+                respuesta = self.cache.obtener(params)
+                if self.contadores:
+                    self.contadores.registrar("moodle_ws", aciertos=int(respuesta is not None), fallos=int(respuesta is None))
+                if respuesta is not None:
+                    return respuesta
+            etiquetas["origen"] = "moodle"
+            try:
+                respuesta = self._enviar(params)
+            except Exception:
+                etiquetas["origen"] = "error"
+                raise
+        if self.cache:
+            self.cache.guardar(params, respuesta)
+        return respuesta
+
+    def _enviar(self, params: dict) -> dict:
+        """Envía petición POST reutilizando las conexiones abiertas del pool.
+        
+        Reintenta con backoff exponencial y jitter ante 429, 5xx, timeouts y errores de conexión.
+        """
+        for intento in range(self.max_reintentos + 1):
+            self.limitador.adquirir()
+            inicio = time.monotonic()
+            try:
+                resp = self.session.post(self.base_url, data=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self._registrar_sobrecarga()
+                if intento == self.max_reintentos:
+                    raise
+                time.sleep(self._backoff(intento))
+                continue
+            
+            if resp.status_code == 429 or resp.status_code >= 500:
+                self._registrar_sobrecarga()
+                if intento == self.max_reintentos:
+                    resp.raise_for_status()
+                time.sleep(self._backoff(intento, resp.headers.get("Retry-After")))
+                continue
+            
+            resp.raise_for_status()
+            self.limitador.registrar_exito(time.monotonic() - inicio)
+            return resp.json()
+
+    def _registrar_sobrecarga(self):
+        """Avisa al limitador; si abre el circuito, la pausa queda en las métricas y en la extracción en curso"""
+        if self.limitador.registrar_sobrecarga():
+            registrar_metrica("moodle_circuito_pausa_segundos", self.limitador.pausa_circuito)
+            pausas = PAUSAS_EXTRACCION.get()
+            if pausas is not None:
+                pausas.append(self.limitador.pausa_circuito)
+
+    def _backoff(self, intento, retry_after=None):
+        """Espera exponencial con jitter completo; respeta Retry-After si Moodle lo envía"""
+        if retry_after:
+            try:
+                return min(MOODLE_BACKOFF_MAX, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(MOODLE_BACKOFF_MAX, MOODLE_BACKOFF_BASE * (2 ** intento)))
+
+@st.cache_resource
+def obtener_cache_ws():
+    """Cache de respuestas de Moodle compartido entre reruns y sesiones"""
+    return CacheRespuestasWS()
+
+@st.cache_resource
+def obtener_cliente_moodle(base_url, pool_size, connect_timeout, read_timeout):
+    """Cliente Moodle compartido entre reruns y sesiones de Streamlit"""
+    cache = obtener_cache_ws() if WS_CACHE_ENABLED else None
+    return ClienteMoodle(base_url, pool_size, (connect_timeout, read_timeout), cache=cache,
+                         contadores=obtener_contadores_cache())
+
+def avisar_pausas_moodle(pausas):
+    """Muestra las pausas de Moodle (segundos de cada una) provocadas por una extracción"""
+    if pausas:
+        st.warning(
+            f"⏸️ Moodle respondió con errores repetidos: las consultas se pausaron {len(pausas)} "
+            f"{'vez' if len(pausas) == 1 else 'veces'} ({sum(pausas):.0f}s en total)"
+        )
+
+def llamar_ws(params: dict, usar_cache: bool = True) -> dict:
+    """Envía petición POST al endpoint REST de Moodle (usar_cache=False fuerza la consulta)"""
+    cliente = obtener_cliente_moodle(MOODLE_BASE_URL, MOODLE_POOL_SIZE, MOODLE_CONNECT_TIMEOUT, MOODLE_READ_TIMEOUT)
+    return cliente.llamar(params, usar_cache=usar_cache)
 
 def obtener_nombre_assignment(course_id: int, assignment_id: int) -> str:
     """Obtiene el nombre de la assignment"""
+    return obtener_indice_assignments().obtener(course_id, assignment_id).get("assignment_name", "")
+
+def _obtener_grades_detalle_lote_ws(assignment_ids: list, since: int = 0, usar_cache: bool = True) -> dict:
+    """Una sola llamada a mod_assign_get_grades; retorna {assignment_id: {userid: registro_grade}}.
+    
+    Con since solo se reciben las calificaciones modificadas desde ese timestamp.
+    """
     params = {
         "wstoken": MOODLE_TOKEN,
-        "wsfunction": "mod_assign_get_assignments",
+        "wsfunction": "mod_assign_get_grades",
         "moodlewsrestformat": "json",
-        "courseids[0]": course_id
     }
-    resultado = llamar_ws(params)
-    courses = resultado.get("courses", [])
-    for curso in courses:
-        assignments = curso.get("assignments", [])
-        for a in assignments:
-            if a.get("id") == assignment_id:
-                return a.get("name", "")
-    return ""
+    for i, assignment_id in enumerate(assignment_ids):
+        params[f"assignmentids[{i}]"] = int(assignment_id)
+    if since:
+        params["since"] = int(since)
+    resultado = llamar_ws(params, usar_cache=usar_cache)
+    
+    # Las actividades sin calificaciones no aparecen en la respuesta
+    grades_por_actividad = {int(aid): {} for aid in assignment_ids}
+    for assignment in resultado.get("assignments", []):
+        grades = grades_por_actividad.setdefault(assignment.get("assignmentid"), {})
+        for g in assignment.get("grades", []):
+            grades[g.get("userid")] = g
+    return grades_por_actividad
+
+def _obtener_grades_lote_ws(assignment_ids: list, since: int = 0, usar_cache: bool = True) -> dict:
+    """Una sola llamada a mod_assign_get_grades; retorna {assignment_id: {userid: grade}}"""
+    return {
+        aid: {userid: g.get("grade") for userid, g in grades.items()}
+        for aid, grades in _obtener_grades_detalle_lote_ws(assignment_ids, since, usar_cache).items()
+    }
+
+def dividir_en_lotes(elementos: list, tamano_lote: int) -> list:
+    """Divide una lista en lotes de tamaño máximo tamano_lote"""
+    tamano_lote = max(1, tamano_lote)
+    return [elementos[i:i + tamano_lote] for i in range(0, len(elementos), tamano_lote)]
 
 def obtener_grades(assignment_id: int) -> dict:
     """Obtiene calificaciones para una assignment"""
-    params = {
-        "wstoken": MOODLE_TOKEN,
-        "wsfunction": "mod_assign_get_grades",
-        "moodlewsrestformat": "json",
-        "assignmentids[0]": assignment_id
-    }
-    resultado = llamar_ws(params)
-    grades = {}
-    assignments = resultado.get("assignments", [])
-    if assignments:
-        for g in assignments[0].get("grades", []):
-            userid = g.get("userid")
-            grades[userid] = g.get("grade")
-    return grades
-
-def obtener_ids_participantes(assignment_id: int) -> list:
-    """Obtiene lista de participantes"""
+    return _obtener_grades_lote_ws([assignment_id]).get(int(assignment_id), {})
+
+def _listar_participantes(assignment_id: int, includeenrolments: int = 1):
+    """Obtiene participantes sin usar Streamlit; retorna (participantes, mensaje_error)"""
     params = {
         "wstoken": MOODLE_TOKEN,
         "wsfunction": "mod_assign_list_participants",
@@ -196,13 +914,12 @@ def obtener_ids_participantes(assignment_id: int) -> list:
         "assignid": assignment_id,
         "groupid": 0,
         "filter": "",
-        "includeenrolments": 1
+        "includeenrolments": includeenrolments
     }
     resultado = llamar_ws(params)
     
     if isinstance(resultado, dict) and resultado.get("exception"):
-        st.error(f"Error en mod_assign_list_participants: {resultado.get('message')}")
-        return []
+        return [], resultado.get('message')
     
     usuarios = resultado if isinstance(resultado, list) else resultado.get("users", [])
     participantes = []
@@ -210,110 +927,1493 @@ def obtener_ids_participantes(assignment_id: int) -> list:
         uid = u.get("id")
         fullname = u.get("fullname", "")
         participantes.append({"id": uid, "fullname": fullname})
-    return participantes
+    return participantes, None
 
-def obtener_feedback(assignment_id: int, user_id: int) -> str:
-    """Obtiene feedback para un estudiante específico"""
+def _listar_participantes_curso(course_id: int):
+    """Usuarios activos del curso que pueden entregar tareas (core_enrol_get_enrolled_users).
+    
+    No depende de ninguna actividad, así que sirve para todas las del curso sin restricciones.
+    Retorna (participantes, mensaje_error).
+    """
     params = {
         "wstoken": MOODLE_TOKEN,
-        "wsfunction": "mod_assign_get_submission_status",
+        "wsfunction": "core_enrol_get_enrolled_users",
         "moodlewsrestformat": "json",
-        "assignid": assignment_id,
-        "userid": user_id,
-        "groupid": 0
+        "courseid": course_id,
+        "options[0][name]": "withcapability",
+        "options[0][value]": "mod/assign:submit",
+        "options[1][name]": "onlyactive",
+        "options[1][value]": 1,
+        "options[2][name]": "userfields",
+        "options[2][value]": "id,fullname"
     }
     resultado = llamar_ws(params)
-    plugins = resultado.get("feedback", {}).get("plugins", [])
-    for plugin in plugins:
+    
+    if isinstance(resultado, dict) and resultado.get("exception"):
+        return [], resultado.get('message')
+    return [{"id": u.get("id"), "fullname": u.get("fullname", "")} for u in resultado], None
+
+def _modulos_sin_restricciones(course_id: int):
+    """cmids de las tareas del curso sin restricciones de acceso ni modo de grupos.
+    
+    Usa core_course_get_contents sin el contenido de los módulos. Una restricción de la sección
+    también cuenta para sus tareas. Retorna (cmids, mensaje_error).
+    """
+    params = {
+        "wstoken": MOODLE_TOKEN,
+        "wsfunction": "core_course_get_contents",
+        "moodlewsrestformat": "json",
+        "courseid": course_id,
+        "options[0][name]": "excludecontents",
+        "options[0][value]": 1,
+        "options[1][name]": "modname",
+        "options[1][value]": "assign"
+    }
+    resultado = llamar_ws(params)
+    
+    if isinstance(resultado, dict) and resultado.get("exception"):
+        return set(), resultado.get('message')
+    
+    libres = set()
+    for seccion in resultado:
+        if seccion.get("availabilityinfo"):
+            continue
+        for modulo in seccion.get("modules", []):
+            if modulo.get("availability") or modulo.get("availabilityinfo") or modulo.get("groupmode"):
+                continue
+            libres.add(modulo.get("id"))
+    return libres, None
+
+class AlmacenRosters:
+    """Participantes por curso: las actividades sin restricciones de un curso comparten la lista.
+    
+    Por curso se guardan los matriculados que pueden entregar y las tareas (cmid) sin
+    restricciones de acceso ni grupos, y se reutilizan ttl segundos. Un lock por curso evita
+    que varias actividades del mismo curso los descarguen a la vez.
+    """
+
+    def __init__(self, ttl=ROSTER_TTL):
+        self.ttl = ttl
+        self._rosters = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _lock_curso(self, course_id):
+        with self._lock:
+            return self._locks.setdefault(course_id, threading.Lock())
+
+    def obtener(self, course_id):
+        """Retorna (participantes, cmids_sin_restricciones, mensaje_error) del curso"""
+        course_id = int(course_id)
+        with self._lock_curso(course_id):
+            entrada = self._rosters.get(course_id)
+            if entrada and time.monotonic() - entrada[0] < self.ttl:
+                return entrada[1], entrada[2], None
+            participantes, error = _listar_participantes_curso(course_id)
+            if error:
+                return [], set(), error
+            libres, error = _modulos_sin_restricciones(course_id)
+            if error:
+                return [], set(), error
+            self._rosters[course_id] = (time.monotonic(), participantes, libres)
+            return participantes, libres, None
+
+@st.cache_resource
+def obtener_almacen_rosters():
+    """Participantes por curso compartidos entre reruns y sesiones de Streamlit"""
+    return AlmacenRosters()
+
+def _requiere_roster_propio(course_id: int, assignment_id: int) -> bool:
+    """Las actividades con entregas en grupo pueden tener participantes distintos a los del curso.
+    
+    Carga el curso en el índice si hace falta (las extracciones masivas lo precargan en lote
+    con precargar_indice_cursos). Si la actividad no aparece en el índice no se puede saber
+    cómo entrega, así que se usa su propia lista de participantes.
+    """
+    registro = obtener_indice_assignments().obtener(course_id, assignment_id)
+    if not registro:
+        return True
+    return bool(registro.get("teamsubmission") or registro.get("preventsubmissionnotingroup"))
+
+def precargar_indice_cursos(course_ids):
+    """Carga en lote los metadatos de los cursos antes de elegir la lista de participantes de sus actividades"""
+    course_ids = [int(c) for c in course_ids]
+    if course_ids:
+        obtener_indice_assignments().cargar_cursos(course_ids)
+
+def _listar_participantes_actividad(course_id: int, assignment_id: int):
+    """Participantes de una actividad usando la lista del curso cuando es posible.
+    
+    Las tareas con restricciones de acceso o modo de grupos (o que no se pudieron comprobar)
+    consultan mod_assign_list_participants, que aplica esos filtros.
+    """
+    if _requiere_roster_propio(course_id, assignment_id):
+        return _listar_participantes(assignment_id)
+    participantes, libres, error = obtener_almacen_rosters().obtener(course_id)
+    cmid = obtener_indice_assignments().obtener(course_id, assignment_id).get("cmid")
+    if error or cmid not in libres:
+        return _listar_participantes(assignment_id)
+    return participantes, None
+
+def obtener_ids_participantes(assignment_id: int, course_id: int = None) -> list:
+    """Obtiene lista de participantes (reutiliza la lista del curso si se indica course_id)"""
+    if course_id is not None:
+        participantes, error = _listar_participantes_actividad(course_id, assignment_id)
+    else:
+        participantes, error = _listar_participantes(assignment_id)
+    if error:
+        st.error(f"Error en mod_assign_list_participants: {error}")
+    return participantes
+
+def _parsear_estado_submission(resultado: dict) -> dict:
+    """Extrae feedback, fechas de envío/calificación y estado de una respuesta de mod_assign_get_submission_status"""
+    feedback_data = resultado.get("feedback") or {}
+    lastattempt = resultado.get("lastattempt") or {}
+    submission = lastattempt.get("submission") or {}
+    
+    feedback = ""
+    for plugin in feedback_data.get("plugins", []):
         if plugin.get("type") == "comments":
             editorfields = plugin.get("editorfields", [])
             if editorfields:
-                return editorfields[0].get("text", "")
-    return ""
+                feedback = editorfields[0].get("text", "")
+                break
+    
+    return {
+        "feedback": feedback,
+        "submission_timestamp": submission.get("timemodified"),
+        "grading_timestamp": lastattempt.get("gradeddate") or (feedback_data.get("grade") or {}).get("timemodified"),
+        "submission_status": submission.get("status", ""),
+    }
+
+class AlmacenEstadosSubmission:
+    """Estados de entrega ya consultados, por (assignment_id, user_id), con expiración.
+    
+    Las entradas se mantienen en orden de guardado, así cada inserción descarta desde el
+    principio las vencidas y, si se supera max_entradas, las más antiguas.
+    """
+
+    def __init__(self, ttl=SUBMISSION_STATUS_TTL, max_entradas=SUBMISSION_STATUS_MAX):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._estados = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, assignment_id, user_id):
+        with self._lock:
+            entrada = self._estados.get((int(assignment_id), int(user_id)))
+        if entrada and time.monotonic() - entrada[0] < self.ttl:
+            return entrada[1]
+        return None
+
+    def guardar(self, assignment_id, user_id, estado):
+        clave = (int(assignment_id), int(user_id))
+        ahora = time.monotonic()
+        with self._lock:
+            self._estados.pop(clave, None)
+            self._estados[clave] = (ahora, estado)
+            while self._estados:
+                primera, (guardado, _) = next(iter(self._estados.items()))
+                if ahora - guardado < self.ttl and len(self._estados) <= self.max_entradas:
+                    break
+                del self._estados[primera]
+
+@st.cache_resource
+def obtener_almacen_estados_submission():
+    """Almacén de estados de entrega compartido entre pestañas, reruns y sesiones"""
+    return AlmacenEstadosSubmission()
+
+def obtener_estado_submission(assignment_id: int, user_id: int) -> dict:
+    """Una sola consulta a mod_assign_get_submission_status sirve feedback y fechas de entrega"""
+    almacen = obtener_almacen_estados_submission()
+    estado = almacen.obtener(assignment_id, user_id)
+    if estado is None:
+        params = {
+            "wstoken": MOODLE_TOKEN,
+            "wsfunction": "mod_assign_get_submission_status",
+            "moodlewsrestformat": "json",
+            "assignid": assignment_id,
+            "userid": user_id,
+            "groupid": 0
+        }
+        estado = _parsear_estado_submission(llamar_ws(params))
+        almacen.guardar(assignment_id, user_id, estado)
+    return estado
+
+def obtener_feedback(assignment_id: int, user_id: int) -> str:
+    """Obtiene feedback para un estudiante específico"""
+    return obtener_estado_submission(assignment_id, user_id)["feedback"]
+
+def obtener_feedback_participantes(assignment_id: int, participantes: list,
+                                   max_workers: int = FEEDBACK_MAX_WORKERS, progreso_callback=None) -> list:
+    """Obtiene el feedback de varios estudiantes en paralelo, en el mismo orden que participantes"""
+    feedbacks = [""] * len(participantes)
+    if not participantes:
+        return feedbacks
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futuros = {
+            executor.submit(obtener_feedback, assignment_id, p["id"]): i
+            for i, p in enumerate(participantes)
+        }
+        # El progreso se reporta desde el hilo principal (Streamlit no admite llamadas desde otros hilos)
+        for completados, futuro in enumerate(as_completed(futuros), start=1):
+            feedbacks[futuros[futuro]] = futuro.result()
+            if progreso_callback:
+                progreso_callback(completados / len(participantes))
+    return feedbacks
+
+# ==========================
+# MOTOR ASÍNCRONO DE EXTRACCIÓN MASIVA
+# ==========================
+def extraer_actividades_async(actividades, con_feedback=False, max_concurrencia=MASIVO_MAX_CONCURRENCIA,
+                              tamano_lote_grades=GRADES_TAMANO_LOTE, progreso_callback=None, filas_callback=None):
+    """Extrae varias actividades en paralelo bajo un límite global de consultas simultáneas.
+    
+    Las calificaciones se piden en lotes de tamano_lote_grades actividades por llamada.
+    filas_callback, si se indica, recibe las filas de cada actividad en cuanto termina
+    (p. ej. EscritorSupabase.agregar para guardar mientras sigue la extracción).
+    Retorna (filas, errores, pausas): filas en el orden de las actividades y de sus participantes,
+    errores como lista de {'course_id', 'assignment_id', 'assignment_name', 'course_name', 'error'}
+    y pausas con los segundos de cada apertura del circuito que provocaron sus propias llamadas.
+    """
+    inicio = time.time()
+    actividades = list(actividades)
+    pausas = []
+    marca = PAUSAS_EXTRACCION.set(pausas)
+    try:
+        precargar_indice_cursos({row['id_curso'] for row in actividades})
+        filas, errores = asyncio.run(_extraer_actividades_async(
+            actividades, con_feedback, max_concurrencia, tamano_lote_grades, progreso_callback, filas_callback
+        ))
+    finally:
+        PAUSAS_EXTRACCION.reset(marca)
+    
+    # Las actividades extraídas completas quedan como punto de partida de la sincronización incremental
+    con_error = {error['assignment_id'] for error in errores}
+    extraidas = [int(row['id']) for row in actividades if int(row['id']) not in con_error]
+    registrar_marcas_grades(extraidas, inicio)
+    return filas, errores, pausas
+
+def descripcion_actividad(error):
+    """Nombre de una actividad con su curso, para los avisos de errores de extracción"""
+    return f"{error['assignment_name']} ({error['course_name'] or error['course_id']}, id {error['assignment_id']})"
+
+async def _extraer_actividades_async(actividades, con_feedback, max_concurrencia, tamano_lote_grades, progreso_callback,
+                                     filas_callback=None):
+    loop = asyncio.get_running_loop()
+    semaforo = asyncio.Semaphore(max(1, max_concurrencia))
+    
+    # Las llamadas HTTP son bloqueantes: se ejecutan en hilos, el semáforo limita cuántas hay en curso
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrencia)) as executor:
+        async def llamar(func, *args):
+            async with semaforo:
+                # Copia el contexto para que el hilo vea PAUSAS_EXTRACCION de esta extracción
+                return await loop.run_in_executor(executor, contextvars.copy_context().run, func, *args)
+        
+        actividades = list(actividades)
+        
+        # Un lote de calificaciones se comparte entre todas las actividades que incluye
+        lotes_grades = {}
+        ids_unicos = list(dict.fromkeys(int(row['id']) for row in actividades))
+        for lote in dividir_en_lotes(ids_unicos, tamano_lote_grades):
+            tarea_lote = asyncio.ensure_future(llamar(_obtener_grades_lote_ws, lote))
+            for assignment_id in lote:
+                lotes_grades[assignment_id] = tarea_lote
+        
+        async def obtener_grades_actividad(assignment_id):
+            try:
+                return (await lotes_grades[assignment_id]).get(assignment_id, {})
+            except Exception:
+                # Si falla el lote, se reintenta solo esta actividad
+                return await llamar(obtener_grades, assignment_id)
+        
+        async def procesar(indice, row):
+            assignment_id = row['id']
+            try:
+                grades_dict, (participantes, error) = await asyncio.gather(
+                    obtener_grades_actividad(int(assignment_id)),
+                    llamar(_listar_participantes_actividad, int(row['id_curso']), assignment_id)
+                )
+                if error:
+                    return indice, [], error
+                
+                if con_feedback:
+                    feedbacks = await asyncio.gather(
+                        *(llamar(obtener_feedback, assignment_id, p["id"]) for p in participantes)
+                    )
+                else:
+                    feedbacks = [None] * len(participantes)
+                
+                filas = []
+                for p, feedback in zip(participantes, feedbacks):
+                    fila = {
+                        "course_id": row['id_curso'],
+                        "course_name": row['NomCurso'],
+                        "docente": row['DOCENTE'],
+                        "assignment_id": assignment_id,
+                        "assignment_name": row['name'],
+                        "user_id": p["id"],
+                        "user_fullname": p["fullname"],
+                        "grade": grades_dict.get(p["id"], "")
+                    }
+                    if con_feedback:
+                        fila["feedback"] = feedback
+                        fila["has_feedback"] = len(str(feedback).strip()) > 0
+                    filas.append(fila)
+                return indice, filas, None
+            except Exception as e:
+                return indice, [], str(e)
+        
+        tareas = [asyncio.ensure_future(procesar(i, row)) for i, row in enumerate(actividades)]
+        resultados = [None] * len(actividades)
+        
+        for completadas, tarea in enumerate(asyncio.as_completed(tareas), start=1):
+            indice, filas, error = await tarea
+            resultados[indice] = (filas, error)
+            if filas_callback and filas:
+                filas_callback(filas)
+            if progreso_callback:
+                progreso_callback(completadas, len(actividades), actividades[indice]['name'])
+    
+    filas_totales = []
+    errores = []
+    for row, (filas, error) in zip(actividades, resultados):
+        filas_totales.extend(filas)
+        if error:
+            errores.append({
+                'course_id': int(row['id_curso']),
+                'assignment_id': int(row['id']),
+                'assignment_name': row['name'],
+                'course_name': row.get('NomCurso'),
+                'error': error
+            })
+    return filas_totales, errores
 
 # ==========================
 # FUNCIONES DE CACHE
 # ==========================
-def crear_cache_key(course_id, assignment_id):
-    """Crea una clave única para el cache"""
-    return hashlib.md5(f"{course_id}_{assignment_id}".encode()).hexdigest()
+def crear_cache_key(course_id, assignment_id, con_feedback=True):
+    """Crea una clave única para el cache de una actividad (con o sin feedback)"""
+    sufijo = "" if con_feedback else "_notas"
+    return hashlib.md5(f"{int(course_id)}_{int(assignment_id)}{sufijo}".encode()).hexdigest()
 
-def crear_cache_key_masivo(identificador):
-    """Crea una clave única para el cache masivo"""
-    return hashlib.md5(f"masivo_{identificador}".encode()).hexdigest()
+class ManifiestoCache(ABC):
+    """Resumen de un cache local que se actualiza en la misma transacción que cada escritura.
+    
+    cache_claves guarda por clave el tipo, los registros, la fecha de guardado y el último
+    acceso; cache_manifiesto acumula consultas, registros y última actualización por tipo.
+    Así la sidebar y la política de cache no recorren los datos. CacheLocal y CacheParquet
+    comparten CACHE_DB y se distinguen por ALMACEN. Las lecturas no toman el bloqueo de
+    escritura: los accesos se guardan en lote con la siguiente escritura o desalojo.
+    """
+    
+    ALMACEN = None
+    
+    def _crear_manifiesto(self):
+        """Crea las tablas del manifiesto (requiere transacción) y lo reconstruye si está vacío"""
+        self._accesos = {}
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_claves (
+                almacen TEXT NOT NULL,
+                cache_key TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                registros INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                accedido REAL NOT NULL,
+                PRIMARY KEY (almacen, cache_key)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_claves_accedido ON cache_claves(almacen, accedido)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_claves_timestamp ON cache_claves(almacen, timestamp)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_manifiesto (
+                almacen TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                consultas INTEGER NOT NULL,
+                registros INTEGER NOT NULL,
+                ultima TEXT,
+                PRIMARY KEY (almacen, tipo)
+            )
+        """)
+        vacio = self._conn.execute(
+            "SELECT 1 FROM cache_claves WHERE almacen = ? LIMIT 1", (self.ALMACEN,)
+        ).fetchone() is None
+        if vacio:
+            self._reconstruir_claves()
+            self._conn.execute("DELETE FROM cache_manifiesto WHERE almacen = ?", (self.ALMACEN,))
+            self._conn.execute("""
+                INSERT INTO cache_manifiesto (almacen, tipo, consultas, registros, ultima)
+                SELECT almacen, tipo, COUNT(*), SUM(registros), MAX(timestamp)
+                FROM cache_claves WHERE almacen = ? GROUP BY tipo
+            """, (self.ALMACEN,))
+    
+    @abstractmethod
+    def _reconstruir_claves(self):
+        """Llena cache_claves a partir de los datos guardados (caches creados sin manifiesto)"""
+    
+    @abstractmethod
+    def _borrar_datos(self, cache_key):
+        """Elimina los datos de una clave (requiere transacción)"""
+    
+    def _registrar_clave(self, cache_key, tipo, registros, timestamp):
+        self._volcar_accesos()
+        self._olvidar_clave(cache_key)
+        self._conn.execute(
+            "INSERT INTO cache_claves (almacen, cache_key, tipo, registros, timestamp, accedido) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.ALMACEN, cache_key, tipo, registros, timestamp, time.time())
+        )
+        self._conn.execute("""
+            INSERT INTO cache_manifiesto (almacen, tipo, consultas, registros, ultima) VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT (almacen, tipo) DO UPDATE SET
+                consultas = consultas + 1,
+                registros = registros + excluded.registros,
+                ultima = MAX(COALESCE(ultima, ''), excluded.ultima)
+        """, (self.ALMACEN, tipo, registros, timestamp))
+    
+    def _olvidar_clave(self, cache_key) -> int:
+        anterior = self._conn.execute(
+            "SELECT tipo, registros FROM cache_claves WHERE almacen = ? AND cache_key = ?", (self.ALMACEN, cache_key)
+        ).fetchone()
+        if anterior is None:
+            return 0
+        tipo, registros = anterior
+        self._conn.execute(
+            "UPDATE cache_manifiesto SET consultas = consultas - 1, registros = registros - ? WHERE almacen = ? AND tipo = ?",
+            (registros, self.ALMACEN, tipo)
+        )
+        self._conn.execute("DELETE FROM cache_claves WHERE almacen = ? AND cache_key = ?", (self.ALMACEN, cache_key))
+        return registros
+    
+    def _eliminar_claves(self, cache_keys) -> int:
+        """Elimina datos y manifiesto de cache_keys (requiere transacción); retorna los registros eliminados"""
+        eliminados = 0
+        for cache_key in cache_keys:
+            self._borrar_datos(cache_key)
+            eliminados += self._olvidar_clave(cache_key)
+        return eliminados
+    
+    def _tocar(self, cache_keys):
+        """Anota en memoria el acceso a cache_keys para el desalojo LRU"""
+        ahora = time.time()
+        with self._lock:
+            for cache_key in cache_keys:
+                self._accesos[cache_key] = ahora
+    
+    def _volcar_accesos(self):
+        """Guarda los accesos pendientes (requiere self._lock y transacción de escritura)"""
+        if self._accesos:
+            self._conn.executemany(
+                "UPDATE cache_claves SET accedido = MAX(accedido, ?) WHERE almacen = ? AND cache_key = ?",
+                [(accedido, self.ALMACEN, cache_key) for cache_key, accedido in self._accesos.items()]
+            )
+            self._accesos = {}
+    
+    def existe(self, cache_key) -> bool:
+        return bool(self.existentes([cache_key]))
+    
+    def existentes(self, cache_keys) -> dict:
+        """{cache_key: timestamp de guardado} de las claves que tienen datos"""
+        encontradas = {}
+        with self._lock:
+            for lote in dividir_en_lotes(list(cache_keys), 500):
+                marcadores = ",".join("?" * len(lote))
+                encontradas.update(self._conn.execute(
+                    f"SELECT cache_key, timestamp FROM cache_claves WHERE almacen = ? AND cache_key IN ({marcadores})",
+                    [self.ALMACEN] + lote
+                ).fetchall())
+        return encontradas
+    
+    def estadisticas(self, tipo) -> dict:
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT consultas, registros, ultima FROM cache_manifiesto WHERE almacen = ? AND tipo = ?",
+                (self.ALMACEN, tipo)
+            ).fetchone()
+        consultas, registros, ultima = fila or (0, 0, None)
+        return {"consultas": consultas, "registros": registros, "ultima": ultima}
+    
+    def purgar(self, antes_de) -> int:
+        """Elimina las claves guardadas antes de antes_de (ISO); retorna los registros eliminados"""
+        with self._lock, transaccion_escritura(self._conn):
+            claves = [fila[0] for fila in self._conn.execute(
+                "SELECT cache_key FROM cache_claves WHERE almacen = ? AND timestamp < ?", (self.ALMACEN, antes_de)
+            ).fetchall()]
+            return self._eliminar_claves(claves)
+    
+    def desalojar(self, max_registros) -> int:
+        """Elimina las claves usadas hace más tiempo hasta quedar en max_registros"""
+        eliminados = 0
+        with self._lock, transaccion_escritura(self._conn):
+            self._volcar_accesos()
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(registros), 0) FROM cache_manifiesto WHERE almacen = ?", (self.ALMACEN,)
+            ).fetchone()[0]
+            if total <= max_registros:
+                return 0
+            for (cache_key,) in self._conn.execute(
+                "SELECT cache_key FROM cache_claves WHERE almacen = ? ORDER BY accedido", (self.ALMACEN,)
+            ).fetchall():
+                if total - eliminados <= max_registros:
+                    break
+                eliminados += self._eliminar_claves([cache_key])
+        return eliminados
+    
+    def limpiar(self, tipo=None):
+        with self._lock, transaccion_escritura(self._conn):
+            consulta = "SELECT cache_key FROM cache_claves WHERE almacen = ?"
+            parametros = (self.ALMACEN,) if tipo is None else (self.ALMACEN, tipo)
+            if tipo is not None:
+                consulta += " AND tipo = ?"
+            self._eliminar_claves([fila[0] for fila in self._conn.execute(consulta, parametros).fetchall()])
 
-def existe_en_cache(course_id, assignment_id):
-    """Verifica si ya existe data en cache"""
-    if not os.path.exists(CACHE_CSV):
-        return False
+def _sql_caso_especial():
+    """Expresión CASE de la columna caso a partir de RANGOS_CASOS (sobre las columnas nota y has_feedback)"""
+    ramas = "\n".join(
+        f"WHEN nota BETWEEN {minimo} AND {maximo} THEN '{caso}'" for caso, (minimo, maximo) in RANGOS_CASOS.items()
+    )
+    return f"CASE WHEN nota IS NULL OR nota = 0 THEN 'sin_calificacion' WHEN has_feedback THEN NULL {ramas} END"
+
+# Vista casos_especiales del cache local, sobre los registros con feedback consultado. GLOB
+# reproduce PATRON_NOTA: empieza con dígito, solo dígitos y a lo sumo un punto, no termina en punto
+SQL_VISTA_CASOS_LOCAL = f"""
+    CREATE VIEW casos_especiales AS
+    SELECT course_id, assignment_id, course_name, assignment_name, docente,
+           user_id, user_fullname, grade, has_feedback, {_sql_caso_especial()} AS caso
+    FROM (
+        SELECT *,
+               CASE WHEN TRIM(grade) GLOB '[0-9]*' AND TRIM(grade) NOT GLOB '*[^0-9.]*'
+                         AND TRIM(grade) NOT GLOB '*.*.*' AND TRIM(grade) NOT GLOB '*.'
+                    THEN CAST(TRIM(grade) AS REAL) END AS nota
+        FROM cache_registros
+        WHERE has_feedback IS NOT NULL
+    )
+"""
+
+class CacheLocal(ManifiestoCache):
+    """Cache local de calificaciones en SQLite (CACHE_DB).
+    
+    Cada fila es un estudiante de una actividad bajo una cache_key (una por actividad, ver
+    crear_cache_key); guardar una clave hace upsert de sus filas y elimina las que ya no
+    vienen. WAL permite leer mientras otra sesión escribe.
+    """
+    
+    ALMACEN = "sqlite"
+    COLUMNAS = [
+        "course_id", "assignment_id", "user_id", "user_fullname", "assignment_name",
+        "course_name", "docente", "grade", "feedback", "has_feedback"
+    ]
+    
+    def __init__(self, ruta=CACHE_DB):
+        self._lock = threading.Lock()
+        self._conn = _conectar_sqlite(ruta)
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_registros (
+                    cache_key TEXT NOT NULL,
+                    tipo TEXT NOT NULL,
+                    identificador TEXT,
+                    timestamp TEXT NOT NULL,
+                    course_id INTEGER,
+                    assignment_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    user_fullname TEXT,
+                    assignment_name TEXT,
+                    course_name TEXT,
+                    docente TEXT,
+                    grade TEXT,
+                    feedback TEXT,
+                    has_feedback INTEGER,
+                    PRIMARY KEY (cache_key, assignment_id, user_id)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_actividad ON cache_registros(course_id, assignment_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_usuario ON cache_registros(user_id)")
+            # Se recrea para que siempre siga la regla actual de RANGOS_CASOS
+            self._conn.execute("DROP VIEW IF EXISTS casos_especiales")
+            self._conn.execute(SQL_VISTA_CASOS_LOCAL)
+            self._crear_manifiesto()
+    
+    def _reconstruir_claves(self):
+        self._conn.execute("""
+            INSERT INTO cache_claves (almacen, cache_key, tipo, registros, timestamp, accedido)
+            SELECT ?, cache_key, MAX(tipo), COUNT(*), MAX(timestamp), 0
+            FROM cache_registros GROUP BY cache_key
+        """, (self.ALMACEN,))
+    
+    def _borrar_datos(self, cache_key):
+        self._conn.execute("DELETE FROM cache_registros WHERE cache_key = ?", (cache_key,))
+    
+    def obtener(self, cache_key) -> pd.DataFrame:
+        return self.obtener_varias([cache_key])
+    
+    def obtener_varias(self, cache_keys) -> pd.DataFrame:
+        cache_keys = list(cache_keys)
+        partes = []
+        with self._lock:
+            for lote in dividir_en_lotes(cache_keys, 500):
+                marcadores = ",".join("?" * len(lote))
+                partes.append(pd.read_sql_query(
+                    f"SELECT * FROM cache_registros WHERE cache_key IN ({marcadores})", self._conn, params=lote
+                ))
+        if not partes:
+            return pd.DataFrame()
+        self._tocar(cache_keys)
+        df = pd.concat(partes, ignore_index=True)
+        # Columnas que no se guardaron para estas claves (p. ej. actividades sin feedback)
+        opcionales = [c for c in ("identificador", "feedback", "has_feedback") if df[c].isna().all()]
+        df = df.drop(columns=["tipo"] + opcionales)
+        if "has_feedback" in df.columns:
+            df["has_feedback"] = df["has_feedback"].fillna(0).astype(bool)
+        if "grade" in df.columns:
+            df["grade"] = df["grade"].fillna("")
+        return df
     
-    cache_df = pd.read_csv(CACHE_CSV)
-    cache_key = crear_cache_key(course_id, assignment_id)
-    return cache_key in cache_df['cache_key'].values
+    def casos_especiales(self, caso, assignment_ids):
+        """Equivalente local de la vista casos_especiales y de resumen_casos_especiales.
+        
+        Retorna (df_casos, df_resumen, total_registros) para las actividades indicadas.
+        """
+        ids = json.dumps([int(a) for a in assignment_ids])
+        with self._lock:
+            df_casos = pd.read_sql_query(
+                "SELECT * FROM casos_especiales "
+                "WHERE caso = ? AND assignment_id IN (SELECT value FROM json_each(?))",
+                self._conn, params=(caso, ids)
+            )
+            df_resumen = pd.read_sql_query("""
+                SELECT user_fullname, MIN(course_name) AS course_name, MIN(docente) AS docente, COUNT(*) AS casos
+                FROM casos_especiales
+                WHERE caso = ? AND assignment_id IN (SELECT value FROM json_each(?))
+                GROUP BY user_fullname
+                ORDER BY user_fullname
+            """, self._conn, params=(caso, ids))
+            total = self._conn.execute(
+                "SELECT COUNT(*) FROM casos_especiales WHERE assignment_id IN (SELECT value FROM json_each(?))",
+                (ids,)
+            ).fetchone()[0]
+        df_casos["has_feedback"] = df_casos["has_feedback"].astype(bool)
+        return df_casos.drop(columns=["caso"]), df_resumen, total
+    
+    def guardar(self, cache_key, tipo, data, identificador=None):
+        timestamp = datetime.now().isoformat()
+        columnas = [c for c in self.COLUMNAS if c in data.columns]
+        valores = data[columnas].astype(object).where(data[columnas].notna(), None)
+        if "grade" in valores.columns:
+            valores["grade"] = valores["grade"].map(lambda g: None if g is None else str(g))
+        if "has_feedback" in valores.columns:
+            valores["has_feedback"] = valores["has_feedback"].map(lambda h: None if h is None else int(bool(h)))
+        
+        todas = ["cache_key", "tipo", "identificador", "timestamp"] + columnas
+        actualizar = ", ".join(f"{c} = excluded.{c}" for c in todas[1:])
+        filas = [(cache_key, tipo, identificador, timestamp) + tuple(fila) for fila in valores.itertuples(index=False)]
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.executemany(
+                f"INSERT INTO cache_registros ({', '.join(todas)}) VALUES ({', '.join('?' * len(todas))}) "
+                f"ON CONFLICT (cache_key, assignment_id, user_id) DO UPDATE SET {actualizar}",
+                filas
+            )
+            # Filas de una versión anterior de esta clave que ya no vienen en data
+            self._conn.execute(
+                "DELETE FROM cache_registros WHERE cache_key = ? AND timestamp <> ?", (cache_key, timestamp)
+            )
+            registros = self._conn.execute(
+                "SELECT COUNT(*) FROM cache_registros WHERE cache_key = ?", (cache_key,)
+            ).fetchone()[0]
+            self._registrar_clave(cache_key, tipo, registros, timestamp)
 
-def existe_en_cache_masivo(identificador):
-    """Verifica si ya existe data en cache masivo"""
-    if not os.path.exists(CACHE_MASIVO_CSV):
-        return False
+class CacheParquet(ManifiestoCache):
+    """Cache local columnar: un archivo Parquet por cache_key dentro de cada partición
+    course_id=<id>/assignment_id=<id>.
+    
+    Las columnas se guardan tipadas (has_feedback booleano, nombres como categorías; grade
+    queda como texto, igual que en Moodle y en CacheLocal) y un índice en CACHE_DB indica
+    qué particiones tiene cada clave, de modo que una lectura solo abre esos archivos.
+    Misma interfaz que CacheLocal.
+    """
+    
+    ALMACEN = "parquet"
+    CATEGORICAS = ["course_name", "docente", "assignment_name"]
+    
+    def __init__(self, directorio=CACHE_PARQUET_DIR, ruta_indice=CACHE_DB):
+        self.directorio = directorio
+        self._lock = threading.Lock()
+        self._conn = _conectar_sqlite(ruta_indice)
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_parquet_indice (
+                    cache_key TEXT NOT NULL,
+                    tipo TEXT NOT NULL,
+                    identificador TEXT,
+                    timestamp TEXT NOT NULL,
+                    course_id INTEGER NOT NULL,
+                    assignment_id INTEGER NOT NULL,
+                    registros INTEGER NOT NULL,
+                    PRIMARY KEY (cache_key, course_id, assignment_id)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_parquet_actividad ON cache_parquet_indice(course_id, assignment_id)")
+            self._crear_manifiesto()
+    
+    def _reconstruir_claves(self):
+        self._conn.execute("""
+            INSERT INTO cache_claves (almacen, cache_key, tipo, registros, timestamp, accedido)
+            SELECT ?, cache_key, MAX(tipo), SUM(registros), MAX(timestamp), 0
+            FROM cache_parquet_indice GROUP BY cache_key
+        """, (self.ALMACEN,))
+    
+    def _ruta(self, cache_key, course_id, assignment_id):
+        return os.path.join(self.directorio, f"course_id={int(course_id)}", f"assignment_id={int(assignment_id)}", f"{cache_key}.parquet")
+    
+    def _particiones(self, cache_key):
+        return self._conn.execute(
+            "SELECT course_id, assignment_id, identificador, timestamp FROM cache_parquet_indice WHERE cache_key = ?",
+            (cache_key,)
+        ).fetchall()
+    
+    def _borrar_datos(self, cache_key):
+        for course_id, assignment_id, _, _ in self._particiones(cache_key):
+            ruta = self._ruta(cache_key, course_id, assignment_id)
+            if os.path.exists(ruta):
+                os.remove(ruta)
+        self._conn.execute("DELETE FROM cache_parquet_indice WHERE cache_key = ?", (cache_key,))
+    
+    def leer(self, rutas, columnas=None) -> pd.DataFrame:
+        """Lee archivos del cache, opcionalmente solo algunas columnas"""
+        rutas = [r for r in rutas if os.path.exists(r)]
+        if not rutas:
+            return pd.DataFrame()
+        dataset = ds.dataset(
+            rutas, format="parquet", partitioning="hive", partition_base_dir=self.directorio
+        )
+        # El esquema sale del primer archivo: las columnas sin valores (tipo null) y grade de
+        # archivos que la guardaban numérica se leen como texto para que todos los archivos encajen
+        esquema = dataset.schema
+        for i, campo in enumerate(esquema):
+            if pa.types.is_null(campo.type) or (campo.name == "grade" and not pa.types.is_string(campo.type)):
+                esquema = esquema.set(i, pa.field(campo.name, pa.string()))
+        if esquema != dataset.schema:
+            dataset = ds.dataset(
+                rutas, schema=esquema, format="parquet", partitioning="hive", partition_base_dir=self.directorio
+            )
+        df = dataset.to_table(columns=columnas).to_pandas()
+        for columna in df.columns:
+            if isinstance(df[columna].dtype, pd.CategoricalDtype):
+                df[columna] = df[columna].astype(object)
+        for columna in ("course_id", "assignment_id"):
+            if columna in df.columns:
+                df[columna] = df[columna].astype(int)
+        if "grade" in df.columns:
+            # Las pestañas tratan "" como sin calificación
+            df["grade"] = df["grade"].astype(object).where(df["grade"].notna(), "")
+        return df
+    
+    def obtener(self, cache_key) -> pd.DataFrame:
+        return self.obtener_varias([cache_key])
+    
+    def obtener_varias(self, cache_keys) -> pd.DataFrame:
+        for intento in range(2):
+            rutas = []
+            metadatos = {}
+            with self._lock:
+                for cache_key in cache_keys:
+                    for course_id, assignment_id, identificador, timestamp in self._particiones(cache_key):
+                        rutas.append(self._ruta(cache_key, course_id, assignment_id))
+                        metadatos[cache_key] = (identificador, timestamp)
+            try:
+                df = self.leer(rutas)
+                break
+            except FileNotFoundError:
+                # Otro proceso reemplazó la clave entre la consulta al índice y la lectura
+                if intento == 1:
+                    raise
+        if df.empty:
+            return df
+        self._tocar(list(metadatos))
+        df["timestamp"] = df["cache_key"].map(lambda k: metadatos[k][1])
+        identificadores = df["cache_key"].map(lambda k: metadatos[k][0])
+        if identificadores.notna().any():
+            df["identificador"] = identificadores
+        return df
     
-    cache_df = pd.read_csv(CACHE_MASIVO_CSV)
-    cache_key = crear_cache_key_masivo(identificador)
-    return cache_key in cache_df['cache_key'].values
+    def _tipar(self, data) -> pd.DataFrame:
+        columnas = [c for c in CacheLocal.COLUMNAS if c in data.columns and c not in ("course_id", "assignment_id")]
+        df = data[columnas].copy()
+        if "grade" in df.columns:
+            # Sin conversión numérica: "-", escalas con letras o "16.00000" deben volver tal cual
+            # para que la sincronización incremental compare contra lo que envía Moodle
+            df["grade"] = df["grade"].map(lambda g: None if pd.isna(g) else str(g)).astype(object)
+        if "has_feedback" in df.columns:
+            df["has_feedback"] = df["has_feedback"].fillna(False).astype(bool)
+        if "user_id" in df.columns:
+            df["user_id"] = df["user_id"].astype("int64")
+        for columna in self.CATEGORICAS:
+            if columna in df.columns:
+                df[columna] = df[columna].astype("category")
+        return df
+    
+    def guardar(self, cache_key, tipo, data, identificador=None):
+        timestamp = datetime.now().isoformat()
+        filas_indice = []
+        # Los archivos se escriben antes de tomar el bloqueo de escritura de CACHE_DB, que
+        # solo se usa para actualizar el índice
+        for (course_id, assignment_id), grupo in data.groupby(["course_id", "assignment_id"]):
+            ruta = self._ruta(cache_key, course_id, assignment_id)
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            tabla = pa.Table.from_pandas(self._tipar(grupo).assign(cache_key=cache_key), preserve_index=False)
+            # Escribir aparte y reemplazar: un lector nunca ve un archivo a medio escribir
+            temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+            pq.write_table(tabla, temporal, compression="zstd")
+            os.replace(temporal, ruta)
+            filas_indice.append((cache_key, tipo, identificador, timestamp, int(course_id), int(assignment_id), len(grupo)))
+        
+        with self._lock, transaccion_escritura(self._conn):
+            anteriores = {(c, a) for c, a, _, _ in self._particiones(cache_key)}
+            anteriores -= {(fila[4], fila[5]) for fila in filas_indice}
+            
+            # Particiones de una versión anterior de esta clave que ya no vienen en data
+            for course_id, assignment_id in anteriores:
+                ruta = self._ruta(cache_key, course_id, assignment_id)
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+            self._conn.execute("DELETE FROM cache_parquet_indice WHERE cache_key = ?", (cache_key,))
+            self._conn.executemany(
+                "INSERT INTO cache_parquet_indice (cache_key, tipo, identificador, timestamp, course_id, assignment_id, registros) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                filas_indice
+            )
+            self._registrar_clave(cache_key, tipo, sum(fila[-1] for fila in filas_indice), timestamp)
+
+@st.cache_resource
+def obtener_cache_local():
+    """Cache local compartido entre reruns y sesiones, según CACHE_BACKEND"""
+    if CACHE_BACKEND == "parquet":
+        if pa is not None:
+            return CacheParquet()
+        print("CACHE_BACKEND=parquet requiere pyarrow; se usará SQLite")
+    return CacheLocal()
+
+def _volcar_sin_fallar(almacen):
+    """Vuelca contadores o métricas sin que un error de SQLite llegue a la operación medida.
+    
+    Si la base está ocupada lo pendiente se conserva en memoria y se reintenta en el
+    siguiente intervalo.
+    """
+    try:
+        almacen.volcar()
+    except sqlite3.Error as e:
+        almacen._ultimo_volcado = time.monotonic()
+        print(f"No se pudieron guardar las métricas en {CACHE_DB}: {e}")
+
+class ContadoresCache:
+    """Aciertos y fallos por nivel de cache ("supabase", "local", "moodle_ws").
+    
+    Se acumulan en memoria y se suman a CACHE_DB cada `intervalo` segundos, para no escribir
+    en disco en cada búsqueda; consultarlos no escribe.
+    """
+    
+    def __init__(self, ruta=CACHE_DB, intervalo=METRICAS_INTERVALO_VOLCADO):
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._pendientes = {}
+        self._ultimo_volcado = time.monotonic()
+        self._conn = _conectar_sqlite(ruta)
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_aciertos (
+                    nivel TEXT PRIMARY KEY,
+                    aciertos INTEGER NOT NULL,
+                    fallos INTEGER NOT NULL
+                )
+            """)
+    
+    def registrar(self, nivel, aciertos=0, fallos=0):
+        with self._lock:
+            previos = self._pendientes.get(nivel, (0, 0))
+            self._pendientes[nivel] = (previos[0] + aciertos, previos[1] + fallos)
+            toca_volcar = time.monotonic() - self._ultimo_volcado >= self.intervalo
+        if toca_volcar:
+            _volcar_sin_fallar(self)
+    
+    def volcar(self):
+        """Suma a CACHE_DB los contadores acumulados en memoria"""
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.executemany("""
+                INSERT INTO cache_aciertos (nivel, aciertos, fallos) VALUES (?, ?, ?)
+                ON CONFLICT (nivel) DO UPDATE SET
+                    aciertos = aciertos + excluded.aciertos,
+                    fallos = fallos + excluded.fallos
+            """, [(nivel, a, f) for nivel, (a, f) in self._pendientes.items()])
+            self._pendientes = {}
+            self._ultimo_volcado = time.monotonic()
+    
+    def totales(self) -> dict:
+        """{nivel: (aciertos, fallos)} acumulados, incluidos los aún no guardados (solo lectura)"""
+        with self._lock:
+            totales = {nivel: (a, f) for nivel, a, f in self._conn.execute("SELECT nivel, aciertos, fallos FROM cache_aciertos")}
+            for nivel, (a, f) in self._pendientes.items():
+                previos = totales.get(nivel, (0, 0))
+                totales[nivel] = (previos[0] + a, previos[1] + f)
+        return totales
+    
+    def reiniciar(self):
+        with self._lock, transaccion_escritura(self._conn):
+            self._pendientes = {}
+            self._conn.execute("DELETE FROM cache_aciertos")
+
+@st.cache_resource
+def obtener_contadores_cache():
+    """Contadores de aciertos compartidos entre reruns y sesiones"""
+    return ContadoresCache()
+
+class PoliticaCache:
+    """Decide qué entradas del cache local se pueden servir y cuándo se eliminan.
+    
+    Una entrada es vigente durante ttl_horas; una vencida solo se sirve si servir_vencido
+    (stale-while-revalidate) y en ese caso se programa su actualización en segundo plano.
+    Tras cada guardado se eliminan las vencidas y, si se supera max_registros, las usadas
+    hace más tiempo.
+    """
+    
+    def __init__(self, habilitado=CACHE_ENABLED, ttl_horas=CACHE_EXPIRY_HOURS,
+                 max_registros=CACHE_MAX_REGISTROS, servir_vencido=CACHE_SERVIR_VENCIDO):
+        self.habilitado = habilitado
+        self.ttl_segundos = ttl_horas * 3600
+        self.max_registros = max_registros
+        self.servir_vencido = servir_vencido
+    
+    def _limite(self) -> str:
+        return datetime.fromtimestamp(time.time() - self.ttl_segundos).isoformat()
+    
+    def vigente(self, timestamp) -> bool:
+        return timestamp >= self._limite()
+    
+    def utilizable(self, timestamp) -> bool:
+        return self.habilitado and (self.servir_vencido or self.vigente(timestamp))
+    
+    def mantener(self, cache):
+        if not self.servir_vencido:
+            cache.purgar(self._limite())
+        cache.desalojar(self.max_registros)
+
+POLITICA_CACHE = PoliticaCache()
+
+class RefrescadorCache:
+    """Actualiza en segundo plano las actividades vencidas que se sirvieron del cache"""
+    
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._en_curso = set()
+    
+    def programar(self, df_vencido, con_feedback):
+        """Programa la reextracción de las actividades de df_vencido (una vez por actividad)"""
+        actividades = []
+        for (course_id, assignment_id), grupo in df_vencido.groupby(['course_id', 'assignment_id']):
+            clave = (int(course_id), int(assignment_id), con_feedback)
+            with self._lock:
+                if clave in self._en_curso:
+                    continue
+                self._en_curso.add(clave)
+            primera = grupo.iloc[0]
+            actividades.append({
+                "id_curso": int(course_id),
+                "id": int(assignment_id),
+                "name": primera.get("assignment_name"),
+                "NomCurso": primera.get("course_name"),
+                "DOCENTE": primera.get("docente"),
+            })
+        if actividades:
+            self._executor.submit(self._refrescar, actividades, con_feedback)
+    
+    def _refrescar(self, actividades, con_feedback):
+        try:
+            filas, errores, pausas = extraer_actividades_async(actividades, con_feedback=con_feedback)
+            for error in errores:
+                print(f"Error actualizando en segundo plano {descripcion_actividad(error)}: {error['error']}")
+            if pausas:
+                print(f"Actualización en segundo plano: Moodle se pausó {len(pausas)} veces por errores repetidos")
+            if filas:
+                guardar_actividades_en_cache(pd.DataFrame(filas), "actualizacion", con_feedback)
+        except Exception as e:
+            print(f"Error en la actualización en segundo plano del cache: {e}")
+        finally:
+            with self._lock:
+                for actividad in actividades:
+                    self._en_curso.discard((actividad["id_curso"], actividad["id"], con_feedback))
+
+@st.cache_resource
+def obtener_refrescador_cache():
+    """Refrescador compartido entre reruns y sesiones"""
+    return RefrescadorCache()
+
+def existe_en_cache(course_id, assignment_id):
+    """Verifica si ya existe data utilizable en cache"""
+    guardadas = obtener_cache_local().existentes([crear_cache_key(course_id, assignment_id)])
+    return any(POLITICA_CACHE.utilizable(t) for t in guardadas.values())
 
 def obtener_de_cache(course_id, assignment_id):
     """Obtiene datos del cache"""
-    cache_df = pd.read_csv(CACHE_CSV)
-    cache_key = crear_cache_key(course_id, assignment_id)
-    return cache_df[cache_df['cache_key'] == cache_key]
-
-def obtener_de_cache_masivo(identificador):
-    """Obtiene datos del cache masivo"""
-    cache_df = pd.read_csv(CACHE_MASIVO_CSV)
-    cache_key = crear_cache_key_masivo(identificador)
-    return cache_df[cache_df['cache_key'] == cache_key]
+    df, _ = obtener_actividades_de_cache([(course_id, assignment_id)], con_feedback=True)
+    return df
 
 def guardar_en_cache(data, course_id, assignment_id):
     """Guarda datos en cache"""
-    cache_key = crear_cache_key(course_id, assignment_id)
-    timestamp = datetime.now().isoformat()
-    
-    # Agregar metadata al dataframe
-    data['cache_key'] = cache_key
-    data['timestamp'] = timestamp
+    if not POLITICA_CACHE.habilitado:
+        return
     data['course_id'] = course_id
     data['assignment_id'] = assignment_id
+    cache = obtener_cache_local()
+    cache.guardar(crear_cache_key(course_id, assignment_id), 'individual', data)
+    POLITICA_CACHE.mantener(cache)
+
+def obtener_actividades_de_cache(actividades, con_feedback=False):
+    """Obtiene del cache las actividades [(course_id, assignment_id)] que estén guardadas.
+    
+    Sin feedback también sirven las actividades guardadas con feedback. Las vencidas que se
+    sirven (CACHE_SERVIR_VENCIDO) se actualizan en segundo plano. Retorna (df, actividades_encontradas).
+    """
+    if not POLITICA_CACHE.habilitado:
+        return pd.DataFrame(), set()
+    
+    cache = obtener_cache_local()
+    candidatas = {}
+    for course_id, assignment_id in actividades:
+        actividad = (int(course_id), int(assignment_id))
+        claves = [crear_cache_key(*actividad)]
+        if not con_feedback:
+            claves.append(crear_cache_key(*actividad, con_feedback=False))
+        candidatas[actividad] = claves
+    
+    existentes = cache.existentes([k for claves in candidatas.values() for k in claves])
+    elegidas = {}
+    vencidas = set()
+    for actividad, claves in candidatas.items():
+        utilizables = [k for k in claves if k in existentes and POLITICA_CACHE.utilizable(existentes[k])]
+        # Preferir una entrada vigente sobre una vencida
+        vigentes = [k for k in utilizables if POLITICA_CACHE.vigente(existentes[k])]
+        if vigentes:
+            elegidas[actividad] = vigentes[0]
+        elif utilizables:
+            elegidas[actividad] = utilizables[0]
+            vencidas.add(actividad)
+    
+    if not elegidas:
+        return pd.DataFrame(), set()
+    
+    df = cache.obtener_varias(list(elegidas.values()))
+    if vencidas and not df.empty:
+        claves = pd.Series(list(zip(df['course_id'].astype(int), df['assignment_id'].astype(int))), index=df.index)
+        obtener_refrescador_cache().programar(df[claves.isin(vencidas)], con_feedback)
+    return df, set(elegidas)
+
+def guardar_actividades_en_cache(data, identificador, con_feedback=False):
+    """Guarda en cache cada actividad de data bajo su propia clave"""
+    if not POLITICA_CACHE.habilitado or data.empty:
+        return
+    cache = obtener_cache_local()
+    for (course_id, assignment_id), grupo in data.groupby(['course_id', 'assignment_id']):
+        cache.guardar(
+            crear_cache_key(course_id, assignment_id, con_feedback), 'masivo', grupo.copy(), str(identificador)
+        )
+    POLITICA_CACHE.mantener(cache)
+
+# ==========================
+# MÉTRICAS DE RENDIMIENTO
+# ==========================
+class MetricasRendimiento:
+    """Histogramas de latencia por métrica y etiquetas (nivel de cache, wsfunction, ...).
+    
+    Las observaciones se acumulan en memoria y se suman a CACHE_DB cada `intervalo` segundos,
+    así se conservan entre sesiones y reinicios sin escribir en cada llamada. Consultarlas no
+    escribe: se combinan las guardadas con las pendientes.
+    """
+    
+    def __init__(self, ruta=CACHE_DB, cubetas=CUBETAS_LATENCIA, intervalo=METRICAS_INTERVALO_VOLCADO):
+        self.cubetas = tuple(cubetas)
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._pendientes = {}
+        self._ultimo_volcado = time.monotonic()
+        self._conn = _conectar_sqlite(ruta)
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS metricas (
+                    nombre TEXT NOT NULL,
+                    etiquetas TEXT NOT NULL,
+                    cubetas TEXT NOT NULL,
+                    suma REAL NOT NULL,
+                    cuenta INTEGER NOT NULL,
+                    PRIMARY KEY (nombre, etiquetas)
+                )
+            """)
+    
+    def observar(self, nombre, segundos, **etiquetas):
+        clave = (nombre, json.dumps(etiquetas, sort_keys=True))
+        with self._lock:
+            serie = self._pendientes.get(clave)
+            if serie is None:
+                # Una cubeta por límite más la de +Inf
+                serie = self._pendientes[clave] = [[0] * (len(self.cubetas) + 1), 0.0, 0]
+            serie[0][bisect.bisect_left(self.cubetas, segundos)] += 1
+            serie[1] += segundos
+            serie[2] += 1
+            toca_volcar = time.monotonic() - self._ultimo_volcado >= self.intervalo
+        if toca_volcar:
+            _volcar_sin_fallar(self)
+    
+    def volcar(self):
+        """Suma a CACHE_DB las observaciones acumuladas en memoria"""
+        with self._lock, transaccion_escritura(self._conn):
+            for (nombre, etiquetas), (cubetas, suma, cuenta) in self._pendientes.items():
+                fila = self._conn.execute(
+                    "SELECT cubetas, suma, cuenta FROM metricas WHERE nombre = ? AND etiquetas = ?", (nombre, etiquetas)
+                ).fetchone()
+                if fila:
+                    cubetas = [a + b for a, b in zip(cubetas, json.loads(fila[0]))]
+                    suma += fila[1]
+                    cuenta += fila[2]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO metricas (nombre, etiquetas, cubetas, suma, cuenta) VALUES (?, ?, ?, ?, ?)",
+                    (nombre, etiquetas, json.dumps(cubetas), suma, cuenta)
+                )
+            self._pendientes = {}
+            self._ultimo_volcado = time.monotonic()
+    
+    def series(self) -> list:
+        """Todas las series, incluidas las aún no guardadas: [{metrica, etiquetas, cubetas, suma, cuenta}]"""
+        with self._lock:
+            combinadas = {
+                (nombre, etiquetas): [json.loads(cubetas), suma, cuenta]
+                for nombre, etiquetas, cubetas, suma, cuenta in self._conn.execute(
+                    "SELECT nombre, etiquetas, cubetas, suma, cuenta FROM metricas"
+                )
+            }
+            for clave, (cubetas, suma, cuenta) in self._pendientes.items():
+                previa = combinadas.get(clave)
+                if previa:
+                    combinadas[clave] = [[a + b for a, b in zip(previa[0], cubetas)], previa[1] + suma, previa[2] + cuenta]
+                else:
+                    combinadas[clave] = [list(cubetas), suma, cuenta]
+        return [
+            {"metrica": nombre, "etiquetas": json.loads(etiquetas), "cubetas": cubetas, "suma": suma, "cuenta": cuenta}
+            for (nombre, etiquetas), (cubetas, suma, cuenta) in sorted(combinadas.items())
+        ]
     
-    # Si el archivo existe, agregamos los datos
-    if os.path.exists(CACHE_CSV):
-        existing_cache = pd.read_csv(CACHE_CSV)
-        # Eliminar entradas existentes para este cache_key
-        existing_cache = existing_cache[existing_cache['cache_key'] != cache_key]
-        combined_data = pd.concat([existing_cache, data], ignore_index=True)
-    else:
-        combined_data = data
-    
-    combined_data.to_csv(CACHE_CSV, index=False)
-
-def guardar_en_cache_masivo(data, identificador):
-    """Guarda datos en cache masivo"""
-    cache_key = crear_cache_key_masivo(identificador)
-    timestamp = datetime.now().isoformat()
-    
-    # Agregar metadata al dataframe
-    data['cache_key'] = cache_key
-    data['timestamp'] = timestamp
-    data['identificador'] = identificador
-    
-    # Si el archivo existe, agregamos los datos
-    if os.path.exists(CACHE_MASIVO_CSV):
-        existing_cache = pd.read_csv(CACHE_MASIVO_CSV)
-        # Eliminar entradas existentes para este cache_key
-        existing_cache = existing_cache[existing_cache['cache_key'] != cache_key]
-        combined_data = pd.concat([existing_cache, data], ignore_index=True)
+    def percentil(self, serie, q) -> float:
+        """Límite superior de la cubeta que contiene el percentil q (0-1) de una serie"""
+        objetivo = q * serie["cuenta"]
+        acumulado = 0
+        for limite, cantidad in zip(self.cubetas + (float("inf"),), serie["cubetas"]):
+            acumulado += cantidad
+            if acumulado >= objetivo:
+                return limite
+        return float("inf")
+    
+    def reiniciar(self):
+        with self._lock, transaccion_escritura(self._conn):
+            self._pendientes = {}
+            self._conn.execute("DELETE FROM metricas")
+
+@st.cache_resource
+def obtener_metricas():
+    """Métricas compartidas entre reruns y sesiones"""
+    return MetricasRendimiento()
+
+@contextmanager
+def medir(nombre, **etiquetas):
+    """Registra la duración del bloque; las etiquetas cedidas se pueden completar dentro del bloque"""
+    inicio = time.perf_counter()
+    try:
+        yield etiquetas
+    finally:
+        registrar_metrica(nombre, time.perf_counter() - inicio, **etiquetas)
+
+def registrar_metrica(nombre, segundos, **etiquetas):
+    """Suma una observación si las métricas están habilitadas; un error de SQLite solo se registra en el log"""
+    if not METRICAS_HABILITADAS:
+        return
+    try:
+        obtener_metricas().observar(nombre, segundos, **etiquetas)
+    except sqlite3.Error as e:
+        print(f"No se pudo registrar la métrica {nombre}: {e}")
+
+def exportar_metricas_jsonl() -> str:
+    """Métricas y aciertos de cache, una línea JSON por serie"""
+    lineas = [json.dumps(serie, ensure_ascii=False) for serie in obtener_metricas().series()]
+    for nivel, (aciertos, fallos) in sorted(obtener_contadores_cache().totales().items()):
+        lineas.append(json.dumps({"metrica": "cache_aciertos", "etiquetas": {"nivel": nivel}, "aciertos": aciertos, "fallos": fallos}))
+    return "\n".join(lineas) + "\n"
+
+def _etiquetas_prometheus(etiquetas: dict) -> str:
+    def escapar(valor):
+        return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{k}="{escapar(v)}"' for k, v in sorted(etiquetas.items()))
+
+def exportar_metricas_prometheus() -> str:
+    """Métricas y aciertos de cache en formato de texto de Prometheus"""
+    metricas = obtener_metricas()
+    lineas = []
+    por_nombre = {}
+    for serie in metricas.series():
+        por_nombre.setdefault(serie["metrica"], []).append(serie)
+    for nombre, series in por_nombre.items():
+        metrica = f"calificaciones_{nombre}"
+        lineas.append(f"# TYPE {metrica} histogram")
+        for serie in series:
+            acumulado = 0
+            for limite, cantidad in zip(metricas.cubetas + (float("inf"),), serie["cubetas"]):
+                acumulado += cantidad
+                le = "+Inf" if limite == float("inf") else str(limite)
+                lineas.append(f"{metrica}_bucket{{{_etiquetas_prometheus({**serie['etiquetas'], 'le': le})}}} {acumulado}")
+            etiquetas = _etiquetas_prometheus(serie["etiquetas"])
+            lineas.append(f"{metrica}_sum{{{etiquetas}}} {serie['suma']}")
+            lineas.append(f"{metrica}_count{{{etiquetas}}} {serie['cuenta']}")
+    
+    totales = sorted(obtener_contadores_cache().totales().items())
+    for tipo, indice in (("aciertos", 0), ("fallos", 1)):
+        lineas.append(f"# TYPE calificaciones_cache_{tipo}_total counter")
+        for nivel, valores in totales:
+            lineas.append(f"calificaciones_cache_{tipo}_total{{{_etiquetas_prometheus({'nivel': nivel})}}} {valores[indice]}")
+    return "\n".join(lineas) + "\n"
+
+def mostrar_panel_metricas():
+    """Panel de administración con latencias por nivel y wsfunction, aciertos y exportación"""
+    with st.sidebar.expander("📈 Métricas de Rendimiento (admin)"):
+        # El contenido de un expander se ejecuta aunque esté cerrado: solo se arma si se pide
+        if not st.checkbox("Mostrar métricas", key="mostrar_metricas"):
+            return
+        metricas = obtener_metricas()
+        series = metricas.series()
+        if not series:
+            st.caption("Aún no hay mediciones.")
+            return
+        
+        filas = []
+        for serie in series:
+            filas.append({
+                "Métrica": serie["metrica"],
+                **{k.capitalize(): v for k, v in serie["etiquetas"].items()},
+                "Llamadas": serie["cuenta"],
+                "Promedio (s)": round(serie["suma"] / serie["cuenta"], 3) if serie["cuenta"] else 0,
+                "p50 ≤ (s)": metricas.percentil(serie, 0.5),
+                "p95 ≤ (s)": metricas.percentil(serie, 0.95),
+            })
+        tabla = pd.DataFrame(filas)
+        for nombre, grupo in tabla.groupby("Métrica"):
+            st.markdown(f"**{nombre}**")
+            st.dataframe(grupo.drop(columns="Métrica").dropna(axis=1, how="all"), use_container_width=True, hide_index=True)
+        
+        # Consultas a Moodle resueltas sin salir a la red
+        ws = [s for s in series if s["metrica"] == "moodle_ws_segundos"]
+        total_ws = sum(s["cuenta"] for s in ws)
+        desde_cache = sum(s["cuenta"] for s in ws if s["etiquetas"].get("origen") == "cache")
+        if total_ws:
+            st.metric("Consultas a Moodle evitadas por cache", f"{desde_cache / total_ws:.0%}", help=f"{desde_cache:,} de {total_ws:,}")
+        
+        # Las exportaciones se generan solo al pedirlas
+        if st.button("📦 Preparar exportación"):
+            st.session_state['metricas_exportadas'] = (
+                datetime.now().strftime('%Y%m%d_%H%M%S'), exportar_metricas_jsonl(), exportar_metricas_prometheus()
+            )
+        if 'metricas_exportadas' in st.session_state:
+            marca, jsonl, prometheus = st.session_state['metricas_exportadas']
+            st.download_button("📥 Exportar JSONL", jsonl, file_name=f"metricas_{marca}.jsonl", mime="application/x-ndjson")
+            st.download_button("📥 Exportar Prometheus", prometheus, file_name=f"metricas_{marca}.prom", mime="text/plain")
+        if st.button("🗑️ Reiniciar métricas"):
+            metricas.reiniciar()
+            obtener_contadores_cache().reiniciar()
+            st.session_state.pop('metricas_exportadas', None)
+            st.rerun()
+
+# ==========================
+# SINCRONIZACIÓN INCREMENTAL
+# ==========================
+class MarcasSincronizacion:
+    """Marcas de tiempo de la última sincronización con Moodle, por tipo e id (en CACHE_DB)"""
+
+    def __init__(self, ruta=CACHE_DB):
+        self._lock = threading.Lock()
+        self._conn = _conectar_sqlite(ruta)
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS marcas_sync (
+                    tipo TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    marca REAL NOT NULL,
+                    PRIMARY KEY (tipo, id)
+                )
+            """)
+
+    def obtener(self, tipo, ids) -> dict:
+        ids = [int(i) for i in ids]
+        marcas = {}
+        with self._lock:
+            for lote in dividir_en_lotes(ids, 500):
+                marcadores = ",".join("?" * len(lote))
+                for id_, marca in self._conn.execute(
+                    f"SELECT id, marca FROM marcas_sync WHERE tipo = ? AND id IN ({marcadores})", [tipo] + lote
+                ):
+                    marcas[id_] = marca
+        return marcas
+
+    def registrar(self, tipo, ids, marca):
+        with self._lock, transaccion_escritura(self._conn):
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO marcas_sync (tipo, id, marca) VALUES (?, ?, ?)",
+                [(tipo, int(i), marca) for i in ids]
+            )
+
+@st.cache_resource
+def obtener_marcas_sync():
+    """Marcas de sincronización compartidas entre reruns y sesiones"""
+    return MarcasSincronizacion()
+
+def registrar_marcas_grades(assignment_ids, inicio):
+    """Registra que las calificaciones de estas actividades están al día hasta inicio"""
+    if assignment_ids:
+        obtener_marcas_sync().registrar('grades', assignment_ids, inicio - SYNC_MARGEN_SEGUNDOS)
+
+def sincronizar_grades_incremental(df, assignment_ids=None):
+    """Aplica a df las calificaciones modificadas en Moodle desde la última sincronización.
+    
+    df debe tener assignment_id, user_id y grade; assignment_ids limita qué actividades se
+    consultan (por defecto todas las de df). Retorna (df_actualizado, filas_cambiadas, ids_fallidos).
+    Las actividades sin marca previa se consultan completas una vez para establecerla.
+    """
+    if df.empty:
+        return df, [], set()
+    
+    if assignment_ids is None:
+        assignment_ids = df['assignment_id'].dropna().unique()
+    ids = [int(a) for a in assignment_ids]
+    marcas = obtener_marcas_sync().obtener('grades', ids)
+    # Agrupar actividades con marcas parecidas: cada lote usa la marca más antigua
+    ids.sort(key=lambda a: marcas.get(a, 0))
+    
+    cambios = {}
+    fallidos = set()
+    for lote in dividir_en_lotes(ids, GRADES_TAMANO_LOTE):
+        inicio = time.time()
+        since = min(marcas.get(a, 0) for a in lote)
+        try:
+            grades_lote = _obtener_grades_lote_ws(lote, since=since, usar_cache=False)
+        except Exception as e:
+            print(f"Error sincronizando calificaciones del lote {lote}: {e}")
+            fallidos.update(lote)
+            continue
+        for assignment_id, grades in grades_lote.items():
+            for user_id, grade in grades.items():
+                cambios[(assignment_id, user_id)] = grade
+        registrar_marcas_grades(lote, inicio)
+    
+    if not cambios:
+        return df, [], fallidos
+    
+    df = df.copy()
+    claves = zip(df['assignment_id'].astype(int), df['user_id'].astype(int))
+    nuevos = pd.Series([cambios.get(clave) for clave in claves], index=df.index)
+    modificados = nuevos.notna() & (nuevos.astype(str) != df['grade'].astype(str))
+    if not modificados.any():
+        return df, [], fallidos
+    
+    df.loc[modificados, 'grade'] = nuevos[modificados]
+    return df, df[modificados].to_dict('records'), fallidos
+
+@st.cache_data
+def _mapa_cmid_por_assignment() -> dict:
+    """{assignment_id: cmid} según asignaciones_evaluaciones.csv"""
+    if not os.path.exists(ASIGNACIONES_CSV):
+        return {}
+    df = pd.read_csv(ASIGNACIONES_CSV, usecols=['id', 'cmid']).dropna()
+    return dict(zip(df['id'].astype(int), df['cmid'].astype(int)))
+
+def _obtener_modulos_actualizados_ws(course_id: int, since: float) -> set:
+    """cmids de los módulos de un curso con cambios desde since (core_course_get_updates_since)"""
+    params = {
+        "wstoken": MOODLE_TOKEN,
+        "wsfunction": "core_course_get_updates_since",
+        "moodlewsrestformat": "json",
+        "courseid": int(course_id),
+        "since": int(since)
+    }
+    resultado = llamar_ws(params, usar_cache=False)
+    if isinstance(resultado, dict) and resultado.get("exception"):
+        raise RuntimeError(resultado.get("message"))
+    return {
+        instancia.get("id") for instancia in resultado.get("instances", [])
+        if instancia.get("contextlevel") == "module" and instancia.get("updates")
+    }
+
+def detectar_cambios_cursos(course_ids) -> dict:
+    """Retorna {course_id: cmids modificados} desde la última sincronización de cada curso.
+    
+    Los cursos sin marca previa o cuya consulta falló no aparecen: deben sincronizarse completos.
+    """
+    marcas = obtener_marcas_sync().obtener('curso', course_ids)
+    cambios = {}
+    if not marcas:
+        return cambios
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(MASIVO_MAX_CONCURRENCIA, len(marcas)))) as executor:
+        futuros = {
+            executor.submit(_obtener_modulos_actualizados_ws, course_id, marca): course_id
+            for course_id, marca in marcas.items()
+        }
+        for futuro in as_completed(futuros):
+            try:
+                cambios[futuros[futuro]] = futuro.result()
+            except Exception as e:
+                print(f"Error detectando cambios del curso {futuros[futuro]}: {e}")
+    return cambios
+
+def seleccionar_actividades_con_cambios(df):
+    """Actividades de df que pueden tener calificaciones nuevas.
+    
+    Retorna (assignment_ids, cursos_detectados, actividades_por_curso); cursos_detectados son
+    los cursos revisados con core_course_get_updates_since.
+    """
+    actividades_por_curso = {}
+    for course_id, assignment_id in df[['course_id', 'assignment_id']].drop_duplicates().itertuples(index=False):
+        actividades_por_curso.setdefault(int(course_id), set()).add(int(assignment_id))
+    
+    cursos_detectados = [c for c, ids in actividades_por_curso.items() if len(ids) >= DETECCION_MIN_ACTIVIDADES]
+    cambios = detectar_cambios_cursos(cursos_detectados) if DETECCION_CAMBIOS else {}
+    mapa_cmid = _mapa_cmid_por_assignment()
+    
+    seleccion = set()
+    for course_id, ids in actividades_por_curso.items():
+        if course_id not in cambios:
+            seleccion |= ids
+            continue
+        for assignment_id in ids:
+            cmid = mapa_cmid.get(assignment_id) or obtener_indice_assignments().consultar(course_id, assignment_id).get("cmid")
+            if cmid is None or cmid in cambios[course_id]:
+                seleccion.add(assignment_id)
+    return seleccion, (cursos_detectados if DETECCION_CAMBIOS else []), actividades_por_curso
+
+def aplicar_sincronizacion_incremental(df):
+    """Sincroniza calificaciones de df y propaga los cambios a Supabase; retorna (df, hubo_cambios)"""
+    if not SYNC_INCREMENTAL or df.empty or 'grade' not in df.columns:
+        return df, False
+    
+    inicio = time.time()
+    if 'course_id' in df.columns:
+        seleccion, cursos_detectados, actividades_por_curso = seleccionar_actividades_con_cambios(df)
     else:
-        combined_data = data
+        seleccion, cursos_detectados, actividades_por_curso = None, [], {}
     
-    combined_data.to_csv(CACHE_MASIVO_CSV, index=False)
+    df, cambiadas, fallidos = sincronizar_grades_incremental(df, seleccion)
+    
+    # Un curso queda al día solo si todas sus actividades se sincronizaron sin error
+    cursos_al_dia = [c for c in cursos_detectados if not (actividades_por_curso[c] & fallidos)]
+    if cursos_al_dia:
+        obtener_marcas_sync().registrar('curso', cursos_al_dia, inicio - 300)
+    
+    if cambiadas:
+        actualizar_grades_en_supabase(cambiadas)
+        st.info(f"🔁 {len(cambiadas)} calificaciones actualizadas desde Moodle")
+    return df, bool(cambiadas)
 
 # ==========================
 # FUNCIÓN PRINCIPAL DE EXTRACCIÓN
@@ -321,41 +2421,55 @@ def guardar_en_cache_masivo(data, identificador):
 def extraer_calificaciones_feedback(course_id, assignment_id, assignment_name, course_name, docente):
     """Extrae calificaciones y feedback, primero verifica Supabase, luego cache, finalmente Moodle"""
     
+    contadores = obtener_contadores_cache()
+    
     # 1. Verificar Supabase primero
-    datos_existen, datos_supabase = verificar_datos_en_supabase(course_id, assignment_id)
+    with medir("nivel_segundos", nivel="supabase") as etiquetas:
+        datos_existen, df_supabase = consultar_actividad_supabase(course_id, assignment_id)
+        etiquetas["resultado"] = "acierto" if datos_existen else "fallo"
+    contadores.registrar("supabase", aciertos=int(datos_existen), fallos=int(not datos_existen))
     if datos_existen:
         st.info("🗄️ Datos encontrados en Supabase. Cargando...")
-        df_supabase = obtener_datos_de_supabase(course_id, assignment_id)
-        if not df_supabase.empty:
-            # Agregar campos necesarios si no existen
-            if 'course_id' not in df_supabase.columns:
-                df_supabase['course_id'] = course_id
-            return df_supabase
+        df_supabase, _ = aplicar_sincronizacion_incremental(df_supabase)
+        return df_supabase
     
     # 2. Verificar cache local
-    if existe_en_cache(course_id, assignment_id):
+    with medir("nivel_segundos", nivel="local") as etiquetas:
+        en_cache = existe_en_cache(course_id, assignment_id)
+        etiquetas["resultado"] = "acierto" if en_cache else "fallo"
+        df_cache = obtener_de_cache(course_id, assignment_id) if en_cache else None
+    contadores.registrar("local", aciertos=int(en_cache), fallos=int(not en_cache))
+    if en_cache:
         st.info("📋 Datos encontrados en cache local. Cargando...")
-        return obtener_de_cache(course_id, assignment_id)
+        df_cache, hubo_cambios = aplicar_sincronizacion_incremental(df_cache)
+        if hubo_cambios:
+            guardar_en_cache(df_cache.copy(), course_id, assignment_id)
+        return df_cache
     
     # 3. Extraer de Moodle como último recurso
     st.info("🔄 Obteniendo datos de Moodle...")
     
     try:
-        grades_dict = obtener_grades(assignment_id)
-        participantes = obtener_ids_participantes(assignment_id)
-        
-        if not participantes:
-            st.warning("No se encontraron participantes para esta actividad.")
-            return pd.DataFrame()
+        inicio = time.time()
+        with medir("nivel_segundos", nivel="moodle", resultado="extraccion"):
+            grades_dict = obtener_grades(assignment_id)
+            participantes = obtener_ids_participantes(assignment_id, course_id)
+            
+            if not participantes:
+                st.warning("No se encontraron participantes para esta actividad.")
+                return pd.DataFrame()
+            
+            progress_bar = st.progress(0)
+            feedbacks = obtener_feedback_participantes(
+                assignment_id, participantes, progreso_callback=progress_bar.progress
+            )
         
         datos = []
-        progress_bar = st.progress(0)
         
-        for i, p in enumerate(participantes):
+        for p, feedback in zip(participantes, feedbacks):
             uid = p["id"]
             fullname = p["fullname"]
             grade = grades_dict.get(uid, "")
-            feedback = obtener_feedback(assignment_id, uid)
             
             datos.append({
                 "course_id": course_id,
@@ -369,20 +2483,18 @@ def extraer_calificaciones_feedback(course_id, assignment_id, assignment_name, c
                 "feedback": feedback,
                 "has_feedback": len(str(feedback).strip()) > 0
             })
-            
-            # Actualizar barra de progreso
-            progress_bar.progress((i + 1) / len(participantes))
         
         df = pd.DataFrame(datos)
         
         if not df.empty:
             # Guardar en Supabase
-            exito_supabase, registros_guardados = guardar_datos_en_supabase(datos)
+            exito_supabase, registros_guardados, _ = guardar_datos_en_supabase(datos)
             if exito_supabase:
                 st.success(f"💾 Datos guardados en Supabase: {registros_guardados} registros")
             
             # Guardar en cache local como respaldo
             guardar_en_cache(df.copy(), course_id, assignment_id)
+            registrar_marcas_grades([assignment_id], inicio)
         
         st.success(f"✅ Datos extraídos exitosamente: {len(datos)} estudiantes")
         return df
@@ -391,88 +2503,87 @@ def extraer_calificaciones_feedback(course_id, assignment_id, assignment_name, c
         st.error(f"Error al extraer datos: {str(e)}")
         return pd.DataFrame()
 
+def combinar_con_cache_actividades(df_supabase, actividades_df, actividades_en_supabase, identificador, con_feedback=False):
+    """Completa df_supabase con las actividades seleccionadas que estén en el cache local.
+    
+    Sincroniza las calificaciones del resultado y retorna (df_combinado, actividades_faltantes),
+    donde actividades_faltantes son las filas de actividades_df que hay que extraer de Moodle.
+    """
+    actividades_df_reset = actividades_df.reset_index(drop=True)
+    pendientes = [
+        (row['id_curso'], row['id']) for _, row in actividades_df_reset.iterrows()
+        if (row['id_curso'], row['id']) not in actividades_en_supabase
+    ]
+    
+    with medir("nivel_segundos", nivel="local", resultado="masivo"):
+        df_cache, actividades_en_cache = obtener_actividades_de_cache(pendientes, con_feedback)
+    contadores = obtener_contadores_cache()
+    contadores.registrar("supabase", aciertos=len(actividades_df_reset) - len(pendientes), fallos=len(pendientes))
+    contadores.registrar("local", aciertos=len(actividades_en_cache), fallos=len(pendientes) - len(actividades_en_cache))
+    if actividades_en_cache:
+        st.info(f"📋 Encontradas {len(actividades_en_cache)} actividades en cache local")
+        df_combinado = pd.concat([df_supabase, df_cache], ignore_index=True).drop_duplicates(
+            subset=['course_id', 'assignment_id', 'user_id'], keep='first'
+        )
+    else:
+        df_combinado = df_supabase
+    
+    df_combinado, hubo_cambios = aplicar_sincronizacion_incremental(df_combinado)
+    if hubo_cambios and actividades_en_cache:
+        claves = pd.Series(list(zip(df_combinado['course_id'].astype(int), df_combinado['assignment_id'].astype(int))),
+                           index=df_combinado.index)
+        guardar_actividades_en_cache(df_combinado[claves.isin(actividades_en_cache)], identificador, con_feedback)
+    
+    actividades_faltantes = [
+        row for _, row in actividades_df_reset.iterrows()
+        if (row['id_curso'], row['id']) not in actividades_en_supabase
+        and (int(row['id_curso']), int(row['id'])) not in actividades_en_cache
+    ]
+    return df_combinado, actividades_faltantes
+
 def extraer_calificaciones_masivo(actividades_df, identificador):
     """Extrae calificaciones para múltiples actividades, verifica Supabase primero"""
     
-    # 1. Intentar obtener datos de Supabase primero
-    course_ids = actividades_df['id_curso'].unique().tolist()
-    filtros_supabase = {'course_ids': course_ids}
+    # 1. Intentar obtener datos de Supabase primero, solo de las actividades seleccionadas
+    filtros_supabase = {'actividades': list(zip(actividades_df['id_curso'], actividades_df['id']))}
     
-    df_supabase = obtener_datos_masivos_supabase(filtros_supabase)
+    with medir("nivel_segundos", nivel="supabase", resultado="masivo"):
+        df_supabase = obtener_datos_masivos_supabase(filtros_supabase)
     actividades_en_supabase = set()
     
     if not df_supabase.empty:
         actividades_en_supabase = set(zip(df_supabase['course_id'], df_supabase['assignment_id']))
         st.info(f"🗄️ Encontrados datos en Supabase para {len(actividades_en_supabase)} actividades")
     
-    # 2. Verificar cache masivo
-    if existe_en_cache_masivo(identificador):
-        st.info("📋 Datos encontrados en cache masivo local.")
-        df_cache = obtener_de_cache_masivo(identificador)
-        if not df_cache.empty:
-            # Combinar datos de Supabase y cache si ambos existen
-            if not df_supabase.empty:
-                df_combinado = pd.concat([df_supabase, df_cache], ignore_index=True).drop_duplicates(
-                    subset=['course_id', 'assignment_id', 'user_id'], keep='first'
-                )
-                return df_combinado
-            return df_cache
-    
-    # 3. Determinar qué actividades necesitan ser extraídas de Moodle
-    actividades_df_reset = actividades_df.reset_index(drop=True)
-    actividades_faltantes = []
-    
-    for _, row in actividades_df_reset.iterrows():
-        if (row['id_curso'], row['id']) not in actividades_en_supabase:
-            actividades_faltantes.append(row)
+    # 2. Completar con las actividades del cache local y determinar qué falta extraer de Moodle
+    df_supabase, actividades_faltantes = combinar_con_cache_actividades(
+        df_supabase, actividades_df, actividades_en_supabase, identificador
+    )
     
+    # 3. Extraer de Moodle las actividades faltantes
     if actividades_faltantes:
         st.info(f"🔄 Extrayendo {len(actividades_faltantes)} actividades faltantes de Moodle...")
         
         try:
-            todos_los_datos = []
-            total_actividades = len(actividades_faltantes)
-            
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            for contador, row in enumerate(actividades_faltantes):
-                course_id = row['id_curso']
-                assignment_id = row['id']
-                assignment_name = row['name']
-                course_name = row['NomCurso']
-                docente = row['DOCENTE']
-                
-                status_text.text(f"Procesando: {assignment_name} ({contador + 1}/{total_actividades})")
-                
-                try:
-                    grades_dict = obtener_grades(assignment_id)
-                    participantes = obtener_ids_participantes(assignment_id)
-                    
-                    for p in participantes:
-                        uid = p["id"]
-                        fullname = p["fullname"]
-                        grade = grades_dict.get(uid, "")
-                        
-                        todos_los_datos.append({
-                            "course_id": course_id,
-                            "course_name": course_name,
-                            "docente": docente,
-                            "assignment_id": assignment_id,
-                            "assignment_name": assignment_name,
-                            "user_id": uid,
-                            "user_fullname": fullname,
-                            "grade": grade
-                        })
-                    
-                    time.sleep(0.1)
-                    
-                except Exception as e:
-                    st.warning(f"Error procesando {assignment_name}: {str(e)}")
-                    continue
-                
-                progreso = min((contador + 1) / total_actividades, 1.0)
-                progress_bar.progress(progreso)
+            def actualizar_progreso(completadas, total, assignment_name):
+                status_text.text(f"Procesado: {assignment_name} ({completadas}/{total})")
+                progress_bar.progress(min(completadas / total, 1.0))
+            
+            # Los registros se guardan en Supabase a medida que termina cada actividad
+            with EscritorSupabase() as escritor:
+                with medir("nivel_segundos", nivel="moodle", resultado="masivo"):
+                    todos_los_datos, errores, pausas = extraer_actividades_async(
+                        actividades_faltantes, progreso_callback=actualizar_progreso,
+                        filas_callback=escritor.agregar
+                    )
+            exito_supabase, registros_guardados, reporte_supabase = escritor.cerrar()
+            avisar_lotes_fallidos(reporte_supabase)
+            avisar_pausas_moodle(pausas)
+            for error in errores:
+                st.warning(f"Error procesando {descripcion_actividad(error)}: {error['error']}")
             
             status_text.empty()
             progress_bar.empty()
@@ -480,8 +2591,6 @@ def extraer_calificaciones_masivo(actividades_df, identificador):
             df_nuevos = pd.DataFrame(todos_los_datos)
             
             if not df_nuevos.empty:
-                # Guardar nuevos datos en Supabase
-                exito_supabase, registros_guardados = guardar_datos_en_supabase(todos_los_datos)
                 if exito_supabase:
                     st.success(f"💾 {registros_guardados} nuevos registros guardados en Supabase")
                 
@@ -491,8 +2600,8 @@ def extraer_calificaciones_masivo(actividades_df, identificador):
                 else:
                     df_final = df_nuevos
                 
-                # Guardar en cache masivo
-                guardar_en_cache_masivo(df_final.copy(), identificador)
+                # Guardar en cache local, una entrada por actividad
+                guardar_actividades_en_cache(df_final, identificador)
                 
                 st.success(f"✅ Extracción completada: {len(df_final)} registros totales")
                 return df_final
@@ -500,9 +2609,9 @@ def extraer_calificaciones_masivo(actividades_df, identificador):
         except Exception as e:
             st.error(f"Error al extraer datos masivos: {str(e)}")
     
-    # Retornar datos de Supabase si no hay actividades faltantes
+    # Retornar datos de Supabase y cache si no hay actividades faltantes
     if not df_supabase.empty:
-        st.success(f"✅ Todos los datos obtenidos de Supabase: {len(df_supabase)} registros")
+        st.success(f"✅ Todos los datos obtenidos de Supabase y cache local: {len(df_supabase)} registros")
         return df_supabase
     
     st.warning("No se pudieron obtener datos.")
@@ -533,93 +2642,53 @@ def crear_matriz_calificaciones(df):
 def extraer_datos_con_feedback(actividades_df, identificador):
     """Extrae calificaciones Y feedback, verifica Supabase primero"""
     
-    # 1. Intentar obtener datos completos de Supabase
-    course_ids = actividades_df['id_curso'].unique().tolist()
-    filtros_supabase = {'course_ids': course_ids}
+    # 1. Intentar obtener datos completos de Supabase: primero qué actividades seleccionadas
+    # tienen feedback guardado (solo sus claves) y luego todas las filas de esas actividades
+    filtros_supabase = {
+        'actividades': list(zip(actividades_df['id_curso'], actividades_df['id'])),
+        'solo_con_feedback': True
+    }
     
-    df_supabase = obtener_datos_masivos_supabase(filtros_supabase)
-    actividades_en_supabase = set()
+    with medir("nivel_segundos", nivel="supabase", resultado="masivo"):
+        df_con_feedback = obtener_datos_masivos_supabase(filtros_supabase, columnas=['course_id', 'assignment_id'])
+        actividades_en_supabase = set()
+        df_supabase = pd.DataFrame()
+        if not df_con_feedback.empty:
+            actividades_en_supabase = set(zip(df_con_feedback['course_id'], df_con_feedback['assignment_id']))
+            df_supabase = obtener_datos_masivos_supabase({'actividades': list(actividades_en_supabase)})
     
     if not df_supabase.empty:
-        # Filtrar solo datos que tienen feedback
-        df_supabase_completo = df_supabase[df_supabase['feedback'].notna() & (df_supabase['feedback'] != '')]
-        actividades_en_supabase = set(zip(df_supabase_completo['course_id'], df_supabase_completo['assignment_id']))
-        
-        if not df_supabase_completo.empty:
-            st.info(f"🗄️ Encontrados datos con feedback en Supabase para {len(actividades_en_supabase)} actividades")
+        st.info(f"🗄️ Encontrados datos con feedback en Supabase para {len(actividades_en_supabase)} actividades")
     
-    # 2. Verificar cache local
-    cache_key_feedback = f"{identificador}_feedback"
-    if existe_en_cache_masivo(cache_key_feedback):
-        st.info("📋 Datos con feedback encontrados en cache local.")
-        df_cache = obtener_de_cache_masivo(cache_key_feedback)
-        if not df_cache.empty:
-            # Combinar datos de Supabase y cache si ambos existen
-            if not df_supabase.empty:
-                df_combinado = pd.concat([df_supabase, df_cache], ignore_index=True).drop_duplicates(
-                    subset=['course_id', 'assignment_id', 'user_id'], keep='first'
-                )
-                return df_combinado
-            return df_cache
-    
-    # 3. Determinar qué actividades necesitan extracción completa
-    actividades_df_reset = actividades_df.reset_index(drop=True)
-    actividades_faltantes = []
-    
-    for _, row in actividades_df_reset.iterrows():
-        if (row['id_curso'], row['id']) not in actividades_en_supabase:
-            actividades_faltantes.append(row)
+    # 2. Completar con las actividades del cache local y determinar qué falta extraer de Moodle
+    df_supabase, actividades_faltantes = combinar_con_cache_actividades(
+        df_supabase, actividades_df, actividades_en_supabase, identificador, con_feedback=True
+    )
     
+    # 3. Extraer de Moodle (con feedback) las actividades faltantes
     if actividades_faltantes:
         st.info(f"🔄 Extrayendo {len(actividades_faltantes)} actividades con feedback de Moodle...")
         
         try:
-            todos_los_datos = []
-            total_actividades = len(actividades_faltantes)
-            
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            for contador, row in enumerate(actividades_faltantes):
-                course_id = row['id_curso']
-                assignment_id = row['id']
-                assignment_name = row['name']
-                course_name = row['NomCurso']
-                docente = row['DOCENTE']
-                
-                status_text.text(f"Procesando con feedback: {assignment_name} ({contador + 1}/{total_actividades})")
-                
-                try:
-                    grades_dict = obtener_grades(assignment_id)
-                    participantes = obtener_ids_participantes(assignment_id)
-                    
-                    for p in participantes:
-                        uid = p["id"]
-                        fullname = p["fullname"]
-                        grade = grades_dict.get(uid, "")
-                        feedback = obtener_feedback(assignment_id, uid)
-                        
-                        todos_los_datos.append({
-                            "course_id": course_id,
-                            "course_name": course_name,
-                            "docente": docente,
-                            "assignment_id": assignment_id,
-                            "assignment_name": assignment_name,
-                            "user_id": uid,
-                            "user_fullname": fullname,
-                            "grade": grade,
-                            "feedback": feedback,
-                            "has_feedback": len(str(feedback).strip()) > 0
-                        })
-                    
-                    time.sleep(0.1)
-                    
-                except Exception as e:
-                    st.warning(f"Error procesando {assignment_name}: {str(e)}")
-                    continue
-                
-                progreso = min((contador + 1) / total_actividades, 1.0)
-                progress_bar.progress(progreso)
+            def actualizar_progreso(completadas, total, assignment_name):
+                status_text.text(f"Procesado con feedback: {assignment_name} ({completadas}/{total})")
+                progress_bar.progress(min(completadas / total, 1.0))
+            
+            # Los registros se guardan en Supabase a medida que termina cada actividad
+            with EscritorSupabase() as escritor:
+                with medir("nivel_segundos", nivel="moodle", resultado="masivo"):
+                    todos_los_datos, errores, pausas = extraer_actividades_async(
+                        actividades_faltantes, con_feedback=True, progreso_callback=actualizar_progreso,
+                        filas_callback=escritor.agregar
+                    )
+            exito_supabase, registros_guardados, reporte_supabase = escritor.cerrar()
+            avisar_lotes_fallidos(reporte_supabase)
+            avisar_pausas_moodle(pausas)
+            for error in errores:
+                st.warning(f"Error procesando {descripcion_actividad(error)}: {error['error']}")
             
             status_text.empty()
             progress_bar.empty()
@@ -627,8 +2696,6 @@ def extraer_datos_con_feedback(actividades_df, identificador):
             df_nuevos = pd.DataFrame(todos_los_datos)
             
             if not df_nuevos.empty:
-                # Guardar en Supabase
-                exito_supabase, registros_guardados = guardar_datos_en_supabase(todos_los_datos)
                 if exito_supabase:
                     st.success(f"💾 {registros_guardados} registros con feedback guardados en Supabase")
                 
@@ -638,8 +2705,8 @@ def extraer_datos_con_feedback(actividades_df, identificador):
                 else:
                     df_final = df_nuevos
                 
-                # Guardar en cache
-                guardar_en_cache_masivo(df_final.copy(), cache_key_feedback)
+                # Guardar en cache local, una entrada por actividad
+                guardar_actividades_en_cache(df_final, identificador, con_feedback=True)
                 
                 st.success(f"✅ Extracción con feedback completada: {len(df_final)} registros totales")
                 return df_final
@@ -647,9 +2714,9 @@ def extraer_datos_con_feedback(actividades_df, identificador):
         except Exception as e:
             st.error(f"Error al extraer datos con feedback: {str(e)}")
     
-    # Retornar datos de Supabase si no hay actividades faltantes
+    # Retornar datos de Supabase y cache si no hay actividades faltantes
     if not df_supabase.empty:
-        st.success(f"✅ Todos los datos con feedback obtenidos de Supabase: {len(df_supabase)} registros")
+        st.success(f"✅ Todos los datos con feedback obtenidos de Supabase y cache local: {len(df_supabase)} registros")
         return df_supabase
     
     st.warning("No se pudieron obtener datos con feedback.")
@@ -679,73 +2746,59 @@ def aplicar_filtros(df, filtro_feedback, filtro_calificacion, valor_calificacion
     
     return df_filtrado
 
+def clasificar_casos_especiales(df) -> pd.Series:
+    """Columna caso de la vista casos_especiales calculada sobre un DataFrame (regla de RANGOS_CASOS)"""
+    grade = df['grade'].astype(str).str.strip(' ')
+    nota = pd.to_numeric(grade.where(grade.str.fullmatch(PATRON_NOTA)), errors='coerce')
+    sin_feedback = ~df['has_feedback'].fillna(True).astype(bool)
+    caso = pd.Series(None, index=df.index, dtype=object)
+    for nombre, (minimo, maximo) in RANGOS_CASOS.items():
+        caso[sin_feedback & nota.between(minimo, maximo)] = nombre
+    caso[nota.isna() | (nota == 0)] = 'sin_calificacion'
+    return caso
+
 def aplicar_filtros_casos_especiales(df, tipo_caso, actividades_seleccionadas=None):
-    """Aplica filtros para casos especiales de análisis"""
-    df_filtrado = df.copy()
-    
-    if tipo_caso == "Calificación 16-18 sin feedback":
-        # Convertir grades a numérico
-        df_filtrado['grade_numeric'] = pd.to_numeric(df_filtrado['grade'], errors='coerce')
-        df_filtrado = df_filtrado[
-            (df_filtrado['grade_numeric'] >= 16) & 
-            (df_filtrado['grade_numeric'] <= 18) & 
-            (~df_filtrado['has_feedback'])
-        ]
-    
-    elif tipo_caso == "Calificación 14-15 sin feedback":
-        df_filtrado['grade_numeric'] = pd.to_numeric(df_filtrado['grade'], errors='coerce')
-        df_filtrado = df_filtrado[
-            (df_filtrado['grade_numeric'] >= 14) & 
-            (df_filtrado['grade_numeric'] <= 15) & 
-            (~df_filtrado['has_feedback'])
-        ]
-    
-    elif tipo_caso == "Calificación 1-13 sin feedback":
-        df_filtrado['grade_numeric'] = pd.to_numeric(df_filtrado['grade'], errors='coerce')
-        df_filtrado = df_filtrado[
-            (df_filtrado['grade_numeric'] >= 1) & 
-            (df_filtrado['grade_numeric'] <= 13) & 
-            (~df_filtrado['has_feedback'])
-        ]
-    
-    elif tipo_caso == "Sin calificación en actividades específicas":
-        if actividades_seleccionadas:
-            # DEBUG: Agregar información de debug temporal
-            print(f"DEBUG - Actividades recibidas: {actividades_seleccionadas}")
-            print(f"DEBUG - Actividades únicas en datos: {df_filtrado['assignment_name'].unique()}")
-            print(f"DEBUG - Total registros antes de filtrar: {len(df_filtrado)}")
-            
-            # Filtrar primero por actividades específicas
-            df_actividades_especificas = df_filtrado[df_filtrado['assignment_name'].isin(actividades_seleccionadas)]
-            print(f"DEBUG - Registros después de filtrar por actividades: {len(df_actividades_especificas)}")
-            
-            if len(df_actividades_especificas) > 0:
-                # Mostrar algunas calificaciones de ejemplo
-                print(f"DEBUG - Ejemplos de calificaciones: {df_actividades_especificas['grade'].head(10).tolist()}")
-                
-                # Convertir grades a numérico para evaluación más precisa
-                df_actividades_especificas['grade_numeric'] = pd.to_numeric(df_actividades_especificas['grade'], errors='coerce')
-                
-                # Considerar "sin calificación" cuando:
-                # - La calificación es NaN (valores no numéricos, vacíos, None)
-                # - La calificación es exactamente 0
-                # - La calificación es string vacío o guión
-                sin_calificacion_mask = (
-                    df_actividades_especificas['grade_numeric'].isna() |  # NaN (vacíos, None, strings no numéricos)
-                    (df_actividades_especificas['grade_numeric'] == 0) |  # Exactamente 0
-                    (df_actividades_especificas['grade'].astype(str).str.strip().isin(['', '-', 'nan', 'None']))  # Strings vacíos o guiones
-                )
-                
-                print(f"DEBUG - Registros que cumplen criterio sin calificación: {sin_calificacion_mask.sum()}")
-                
-                df_filtrado = df_actividades_especificas[sin_calificacion_mask]
-            else:
-                df_filtrado = pd.DataFrame()
-        else:
-            # Si no hay actividades seleccionadas, mostrar mensaje de error
-            return pd.DataFrame()  # Retornar DataFrame vacío
-    
-    return df_filtrado
+    """Aplica filtros para casos especiales de análisis, con la misma regla que la vista casos_especiales"""
+    caso = CASOS_ESPECIALES.get(tipo_caso)
+    if caso is None:
+        return df.copy()
+    if caso == 'sin_calificacion':
+        # Este caso solo tiene sentido sobre actividades elegidas
+        if not actividades_seleccionadas:
+            return pd.DataFrame()
+        df = df[df['assignment_name'].isin(actividades_seleccionadas)]
+    return df[clasificar_casos_especiales(df) == caso].copy()
+
+def consultar_casos_especiales(tipo_caso, actividades_df, nombres_actividades=None):
+    """Obtiene un caso especial ya filtrado y agregado, sin descargar todos los registros.
+    
+    Usa la vista casos_especiales y la función resumen_casos_especiales de Supabase o, sin
+    Supabase, sus equivalentes en el cache local SQLite. Como en extraer_datos_con_feedback,
+    de Supabase solo cuentan las actividades con algún feedback guardado. Retorna
+    (df_casos, df_resumen, total_registros, origen), o None si no hay dónde consultar.
+    """
+    caso = CASOS_ESPECIALES[tipo_caso]
+    if nombres_actividades is not None:
+        actividades_df = actividades_df[actividades_df['name'].isin(nombres_actividades)]
+    assignment_ids = sorted({int(a) for a in actividades_df['id']})
+    
+    if supabase:
+        with medir("nivel_segundos", nivel="supabase", resultado="casos"):
+            df_casos = leer_supabase_paginado(
+                [('eq', 'caso', caso), ('in_', 'assignment_id', assignment_ids)],
+                COLUMNAS_CASOS, tabla='casos_especiales'
+            )
+            df_resumen = resumen_casos_supabase(caso, assignment_ids)
+            # Mismo conjunto que la vista: registros de actividades con feedback guardado
+            total = contar_supabase([('in_', 'assignment_id', assignment_ids)], tabla='casos_especiales')
+        return df_casos, df_resumen, total, "supabase"
+    
+    cache = obtener_cache_local()
+    if isinstance(cache, CacheLocal):
+        with medir("nivel_segundos", nivel="local", resultado="casos"):
+            df_casos, df_resumen, total = cache.casos_especiales(caso, assignment_ids)
+        return df_casos, df_resumen, total, "local"
+    return None
 
 def ordenar_columnas_evaluacion_integral(df):
     """Ordena las columnas poniendo 'Evaluación Integral' al final"""
@@ -1394,12 +3447,46 @@ def mostrar_pestana_casos_especiales():
         if caso_especial == "Sin calificación en actividades específicas" and len(actividades_para_analizar) == 0:
             boton_habilitado = False
         
-        if st.button("🚀 Extraer y Analizar Casos Especiales", type="primary", disabled=not boton_habilitado):
+        col_extraer, col_consultar = st.columns(2)
+        with col_extraer:
+            extraer_casos = st.button("🚀 Extraer y Analizar Casos Especiales", type="primary", disabled=not boton_habilitado)
+        with col_consultar:
+            consultar_casos = st.button(
+                "⚡ Consultar Casos Guardados",
+                disabled=not boton_habilitado,
+                help="Calcula el caso en Supabase (o en el cache local) con los datos ya guardados, sin extraer de Moodle"
+            )
+        
+        if consultar_casos:
+            with st.spinner("Consultando casos especiales..."):
+                try:
+                    resultado = consultar_casos_especiales(
+                        caso_especial, actividades_seleccionadas,
+                        actividades_para_analizar if caso_especial == "Sin calificación en actividades específicas" else None
+                    )
+                except Exception as e:
+                    st.error(f"Error al consultar casos especiales: {str(e)}")
+                    resultado = None
+                else:
+                    if resultado is None:
+                        st.warning("⚠️ Consultar casos guardados requiere Supabase o el cache local SQLite (CACHE_BACKEND=sqlite).")
+            
+            if resultado is not None:
+                df_casos, df_resumen, total_registros, origen = resultado
+                st.session_state['df_casos'] = df_casos
+                st.session_state['casos_agregados'] = {'resumen': df_resumen, 'total': total_registros}
+                st.session_state['caso_especial'] = caso_especial
+                st.session_state['actividades_para_analizar'] = actividades_para_analizar
+                fuente = "Supabase" if origen == "supabase" else "el cache local"
+                st.success(f"¡Casos consultados en {fuente}! {len(df_casos)} casos de {total_registros} registros guardados.")
+        
+        if extraer_casos:
             with st.spinner("Extrayendo datos para análisis... Esto puede tomar varios minutos."):
                 df_casos = extraer_datos_con_feedback(actividades_seleccionadas, identificador)
                 
                 if not df_casos.empty:
                     st.session_state['df_casos'] = df_casos
+                    st.session_state.pop('casos_agregados', None)
                     st.session_state['caso_especial'] = caso_especial
                     st.session_state['actividades_para_analizar'] = actividades_para_analizar
                     st.success("¡Datos extraídos exitosamente para análisis!")
@@ -1415,7 +3502,9 @@ def mostrar_pestana_casos_especiales():
             st.error("❌ Debes seleccionar al menos una actividad antes de continuar.")
     
     # Mostrar análisis si existen datos
-    if 'df_casos' in st.session_state and not st.session_state['df_casos'].empty:
+    # Los casos consultados ya vienen filtrados y agregados (casos_agregados)
+    agregados = st.session_state.get('casos_agregados')
+    if 'df_casos' in st.session_state and (agregados or not st.session_state['df_casos'].empty):
         st.markdown("---")
         st.subheader("📊 Análisis de Casos Especiales")
         
@@ -1428,7 +3517,10 @@ def mostrar_pestana_casos_especiales():
         st.info(f"🔍 Debug - Actividades para analizar: {actividades_analizar}")
         
         # Aplicar filtro de caso especial
-        df_filtrado = aplicar_filtros_casos_especiales(df_casos, caso_actual, actividades_analizar)
+        if agregados:
+            df_filtrado = df_casos
+        else:
+            df_filtrado = aplicar_filtros_casos_especiales(df_casos, caso_actual, actividades_analizar)
         
         # Debug: Mostrar información después del filtrado
         if not df_filtrado.empty:
@@ -1442,7 +3534,7 @@ def mostrar_pestana_casos_especiales():
             col1, col2, col3, col4 = st.columns(4)
             
             with col1:
-                st.metric("Total Registros", len(df_casos))
+                st.metric("Total Registros", agregados['total'] if agregados else len(df_casos))
             with col2:
                 st.metric("Casos Encontrados", len(df_filtrado))
             with col3:
@@ -1506,13 +3598,18 @@ def mostrar_pestana_casos_especiales():
             # Análisis por estudiante
             if estudiantes_unicos > 0:
                 st.subheader("👥 Análisis por Estudiante")
-                casos_por_estudiante = df_filtrado.groupby('user_fullname').agg({
-                    'assignment_name': 'count',
-                    'course_name': 'first',
-                    'docente': 'first'
-                }).rename(columns={
-                    'assignment_name': 'Cantidad_Casos'
-                }).reset_index()
+                if agregados:
+                    casos_por_estudiante = agregados['resumen'][['user_fullname', 'casos', 'course_name', 'docente']].rename(columns={
+                        'casos': 'Cantidad_Casos'
+                    })
+                else:
+                    casos_por_estudiante = df_filtrado.groupby('user_fullname').agg({
+                        'assignment_name': 'count',
+                        'course_name': 'first',
+                        'docente': 'first'
+                    }).rename(columns={
+                        'assignment_name': 'Cantidad_Casos'
+                    }).reset_index()
                 
                 casos_por_estudiante = casos_por_estudiante.rename(columns={
                     'user_fullname': 'Estudiante',
@@ -1570,11 +3667,12 @@ def mostrar_pestana_busqueda_supabase():
     st.subheader("🎯 Filtros de Búsqueda")
     
     try:
-        # Obtener datos únicos directamente de Supabase para filtros dinámicos
-        response_all = supabase.table('calificaciones_feedback').select('course_name, docente, user_fullname').execute()
-        df_supabase_ref = pd.DataFrame(response_all.data)
+        # Obtener datos únicos de Supabase para filtros dinámicos (reutilizados entre reruns)
+        if st.button("🔄 Actualizar filtros", key="busqueda_actualizar_filtros"):
+            obtener_valores_filtros_supabase.clear()
+        valores_filtros = obtener_valores_filtros_supabase()
         
-        if df_supabase_ref.empty:
+        if not valores_filtros['course_name']:
             st.warning("⚠️ No hay datos en la base de datos Supabase para realizar búsquedas.")
             st.info("💡 **Sugerencia:** Extrae algunos datos primero desde las otras pestañas.")
             return
@@ -1590,7 +3688,7 @@ def mostrar_pestana_busqueda_supabase():
         st.markdown("#### 📚 Filtros Académicos")
         
         # Filtro por Curso
-        cursos_disponibles = ["Todos"] + sorted(df_supabase_ref['course_name'].dropna().unique().tolist())
+        cursos_disponibles = ["Todos"] + valores_filtros['course_name']
         curso_busqueda = st.selectbox(
             "🎓 Curso:",
             cursos_disponibles,
@@ -1615,7 +3713,7 @@ def mostrar_pestana_busqueda_supabase():
         st.markdown("#### 👥 Filtros de Personas")
         
         # Filtro por Profesor
-        docentes_disponibles = ["Todos"] + sorted(df_supabase_ref['docente'].dropna().unique().tolist())
+        docentes_disponibles = ["Todos"] + valores_filtros['docente']
         profesor_busqueda = st.selectbox(
             "👨‍🏫 Profesor:",
             docentes_disponibles,
@@ -1624,7 +3722,7 @@ def mostrar_pestana_busqueda_supabase():
         )
         
         # Filtro por Estudiante
-        estudiantes_disponibles = ["Todos"] + sorted(df_supabase_ref['user_fullname'].dropna().unique().tolist())
+        estudiantes_disponibles = ["Todos"] + valores_filtros['user_fullname']
         estudiante_busqueda = st.selectbox(
             "👨‍🎓 Estudiante:",
             estudiantes_disponibles,
@@ -1702,22 +3800,21 @@ def mostrar_pestana_busqueda_supabase():
     if realizar_busqueda or contar_registros:
         with st.spinner("🔍 Realizando búsqueda en Supabase..."):
             try:
-                # Construir query de Supabase
-                query = supabase.table('calificaciones_feedback').select('*')
+                # Construir filtros de Supabase
+                filtros_query = []
                 
                 # Aplicar filtros
                 if curso_busqueda != "Todos":
-                    query = query.eq('course_name', curso_busqueda)
+                    filtros_query.append(('eq', 'course_name', curso_busqueda))
                 
                 if profesor_busqueda != "Todos":
-                    query = query.eq('docente', profesor_busqueda)
+                    filtros_query.append(('eq', 'docente', profesor_busqueda))
                 
                 if estudiante_busqueda != "Todos":
-                    query = query.eq('user_fullname', estudiante_busqueda)
+                    filtros_query.append(('eq', 'user_fullname', estudiante_busqueda))
                 
                 # Filtro por NRC (requiere join con datos locales)
-                response = query.execute()
-                df_resultados = pd.DataFrame(response.data)
+                df_resultados = leer_supabase_paginado(filtros_query)
                 
                 if not df_resultados.empty and nrc_busqueda != "Todos" and not df_cursos.empty:
                     # Filtrar por NRC usando datos locales
@@ -1896,76 +3993,221 @@ def mostrar_pestana_busqueda_supabase():
 # ==========================
 # FUNCIONES PARA FECHAS DE ACTIVIDADES
 # ==========================
-def obtener_assignments_curso(course_id: int) -> list:
-    """Obtiene todas las assignments de un curso (basado en script verificado)"""
+def _parsear_assignment(assignment: dict, course_id: int) -> dict:
+    """Convierte una assignment de Moodle en registro con fechas en formato ISO"""
+    return {
+        "assignment_id": assignment.get("id"),
+        "assignment_name": assignment.get("name", ""),
+        "course_id": course_id,
+        "intro": assignment.get("intro", ""),
+        "allowsubmissionsfromdate": assignment.get("allowsubmissionsfromdate"),
+        "duedate": assignment.get("duedate"),
+        "cutoffdate": assignment.get("cutoffdate"),
+        "gradingduedate": assignment.get("gradingduedate"),
+        "cmid": assignment.get("cmid"),
+        "teamsubmission": assignment.get("teamsubmission"),
+        "preventsubmissionnotingroup": assignment.get("preventsubmissionnotingroup"),
+        "allowsubmissionsfromdate_iso": datetime.fromtimestamp(assignment.get("allowsubmissionsfromdate", 0)).isoformat() if assignment.get("allowsubmissionsfromdate") else None,
+        "duedate_iso": datetime.fromtimestamp(assignment.get("duedate", 0)).isoformat() if assignment.get("duedate") else None,
+        "cutoffdate_iso": datetime.fromtimestamp(assignment.get("cutoffdate", 0)).isoformat() if assignment.get("cutoffdate") else None,
+        "gradingduedate_iso": datetime.fromtimestamp(assignment.get("gradingduedate", 0)).isoformat() if assignment.get("gradingduedate") else None,
+    }
+
+def _obtener_assignments_lote_ws(course_ids: list) -> dict:
+    """Una sola llamada a mod_assign_get_assignments; retorna {course_id: [assignments]}"""
     params = {
         "wstoken": MOODLE_TOKEN,
         "wsfunction": "mod_assign_get_assignments",
         "moodlewsrestformat": "json",
-        "courseids[0]": course_id,
         "includenotenrolledcourses": 1  # parámetro requerido para ver cursos sin enrolarse
     }
+    for i, course_id in enumerate(course_ids):
+        params[f"courseids[{i}]"] = int(course_id)
     
-    try:
-        resultado = llamar_ws(params)
-        assignments = []
-        
-        for course in resultado.get("courses", []):
-            # algunos WS devuelven 'courseid', otros 'id'
-            cid = course.get("courseid", course.get("id"))
-            if cid != course_id:
-                continue
-                
-            for assignment in course.get("assignments", []):
-                # Convertir timestamps a ISO format
-                assignment_data = {
-                    "assignment_id": assignment.get("id"),
-                    "assignment_name": assignment.get("name", ""),
-                    "course_id": course_id,
-                    "intro": assignment.get("intro", ""),
-                    "allowsubmissionsfromdate": assignment.get("allowsubmissionsfromdate"),
-                    "duedate": assignment.get("duedate"),
-                    "cutoffdate": assignment.get("cutoffdate"),
-                    "gradingduedate": assignment.get("gradingduedate"),
-                    "allowsubmissionsfromdate_iso": datetime.fromtimestamp(assignment.get("allowsubmissionsfromdate", 0)).isoformat() if assignment.get("allowsubmissionsfromdate") else None,
-                    "duedate_iso": datetime.fromtimestamp(assignment.get("duedate", 0)).isoformat() if assignment.get("duedate") else None,
-                    "cutoffdate_iso": datetime.fromtimestamp(assignment.get("cutoffdate", 0)).isoformat() if assignment.get("cutoffdate") else None,
-                    "gradingduedate_iso": datetime.fromtimestamp(assignment.get("gradingduedate", 0)).isoformat() if assignment.get("gradingduedate") else None,
-                }
-                assignments.append(assignment_data)
-                
-        return assignments
+    resultado = llamar_ws(params)
+    assignments_por_curso = {int(cid): [] for cid in course_ids}
+    
+    for course in resultado.get("courses", []):
+        # algunos WS devuelven 'courseid', otros 'id'
+        cid = course.get("courseid", course.get("id"))
+        if cid not in assignments_por_curso:
+            continue
         
+        for assignment in course.get("assignments", []):
+            assignments_por_curso[cid].append(_parsear_assignment(assignment, cid))
+    
+    return assignments_por_curso
+
+def obtener_assignments_cursos(course_ids: list, tamano_lote: int = ASSIGNMENTS_TAMANO_LOTE,
+                               progreso_callback=None) -> dict:
+    """Obtiene las assignments de muchos cursos pidiendo varios cursos por llamada.
+    
+    Retorna {course_id: [assignments]} con los mismos registros que obtener_assignments_curso.
+    Los cursos que no se pudieron consultar no aparecen en el resultado.
+    """
+    lotes = dividir_en_lotes(list(dict.fromkeys(int(c) for c in course_ids)), tamano_lote)
+    assignments_por_curso = {}
+    if not lotes:
+        return assignments_por_curso
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(MASIVO_MAX_CONCURRENCIA, len(lotes)))) as executor:
+        futuros = {executor.submit(_obtener_assignments_lote_ws, lote): lote for lote in lotes}
+        for completados, futuro in enumerate(as_completed(futuros), start=1):
+            try:
+                assignments_por_curso.update(futuro.result())
+            except Exception as e:
+                # Si falla el lote, se consulta curso por curso para no perder los demás
+                print(f"Error obteniendo assignments del lote {futuros[futuro]}: {e}")
+                for course_id in futuros[futuro]:
+                    try:
+                        assignments_por_curso.update(_obtener_assignments_lote_ws([course_id]))
+                    except Exception as e_curso:
+                        print(f"Error obteniendo assignments del curso {course_id}: {e_curso}")
+            if progreso_callback:
+                progreso_callback(completados / len(lotes))
+    
+    return assignments_por_curso
+
+def obtener_assignments_curso(course_id: int) -> list:
+    """Obtiene todas las assignments de un curso (basado en script verificado)"""
+    try:
+        return _obtener_assignments_lote_ws([course_id]).get(int(course_id), [])
     except Exception as e:
         print(f"Error obteniendo assignments del curso {course_id}: {e}")
         return []
 
+class IndiceAssignments:
+    """Índice en memoria {(course_id, assignment_id): registro} compartido por todo el proceso.
+    
+    Cada curso se descarga una sola vez (en lote con otros cursos) y se conserva ttl segundos;
+    las búsquedas posteriores de nombre o fechas no hacen llamadas a Moodle.
+    """
+
+    def __init__(self, ttl=ASSIGNMENTS_INDICE_TTL):
+        self.ttl = ttl
+        self._registros = {}
+        self._assignments_por_curso = {}
+        self._cargado_en = {}
+        self._lock = threading.Lock()
+
+    def _vigente(self, course_id):
+        cargado_en = self._cargado_en.get(course_id)
+        return cargado_en is not None and time.monotonic() - cargado_en < self.ttl
+
+    def cargar_cursos(self, course_ids, progreso_callback=None) -> dict:
+        """Asegura que los cursos estén en el índice; retorna {course_id: [assignments]}"""
+        course_ids = list(dict.fromkeys(int(c) for c in course_ids))
+        with self._lock:
+            faltantes = [c for c in course_ids if not self._vigente(c)]
+        
+        if faltantes:
+            nuevos = obtener_assignments_cursos(faltantes, progreso_callback=progreso_callback)
+            ahora = time.monotonic()
+            with self._lock:
+                for course_id, assignments in nuevos.items():
+                    for anterior in self._assignments_por_curso.get(course_id, []):
+                        self._registros.pop((course_id, anterior.get("assignment_id")), None)
+                    for assignment in assignments:
+                        self._registros[(course_id, assignment.get("assignment_id"))] = assignment
+                    self._assignments_por_curso[course_id] = assignments
+                    self._cargado_en[course_id] = ahora
+        elif progreso_callback:
+            progreso_callback(1.0)
+        
+        with self._lock:
+            return {c: self._assignments_por_curso[c] for c in course_ids if c in self._assignments_por_curso}
+
+    def consultar(self, course_id, assignment_id) -> dict:
+        """Registro de una assignment solo si ya está en el índice (nunca llama a Moodle)"""
+        course_id = int(course_id)
+        with self._lock:
+            if not self._vigente(course_id):
+                return {}
+            return self._registros.get((course_id, int(assignment_id)), {})
+
+    def obtener(self, course_id, assignment_id) -> dict:
+        """Registro de una assignment en O(1); carga el curso si aún no está en el índice"""
+        course_id = int(course_id)
+        self.cargar_cursos([course_id])
+        with self._lock:
+            return self._registros.get((course_id, int(assignment_id)), {})
+
+@st.cache_resource
+def obtener_indice_assignments():
+    """Índice de assignments compartido entre reruns y sesiones de Streamlit"""
+    return IndiceAssignments()
+
 def obtener_fechas_actividad(course_id: int, assignment_id: int) -> dict:
     """Obtiene fechas de una actividad específica"""
-    assignments = obtener_assignments_curso(course_id)
-    
-    for assignment in assignments:
-        if assignment.get("assignment_id") == assignment_id:
-            return assignment
-    
-    return {}
+    return obtener_indice_assignments().obtener(course_id, assignment_id)
 
-def obtener_estado_entrega(assign_id: int, user_id: int, group_id: int = 0) -> dict:
-    """Obtiene el estado de entrega de una tarea específica para un usuario"""
+def _obtener_submissions_lote_ws(assignment_ids: list) -> dict:
+    """Una sola llamada a mod_assign_get_submissions; retorna {assignment_id: {userid: submission}}.
+    
+    Solo incluye las actividades que Moodle devolvió y cuyas entregas son individuales
+    (las entregas grupales llegan con userid 0 y requieren consulta por estudiante).
+    """
     params = {
         "wstoken": MOODLE_TOKEN,
-        "wsfunction": "mod_assign_get_submission_status",
+        "wsfunction": "mod_assign_get_submissions",
         "moodlewsrestformat": "json",
-        "assignid": assign_id,
-        "userid": user_id,
-        "groupid": group_id,
     }
-    return llamar_ws(params)
+    for i, assignment_id in enumerate(assignment_ids):
+        params[f"assignmentids[{i}]"] = int(assignment_id)
+    resultado = llamar_ws(params)
+    
+    submissions_por_actividad = {}
+    for assignment in resultado.get("assignments", []):
+        submissions = assignment.get("submissions", [])
+        if any(not sub.get("userid") for sub in submissions):
+            continue
+        submissions_por_actividad[assignment.get("assignmentid")] = {sub.get("userid"): sub for sub in submissions}
+    return submissions_por_actividad
+
+def obtener_entregas_lote(assignment_ids: list, tamano_lote: int = SUBMISSIONS_TAMANO_LOTE) -> dict:
+    """Estados de entrega de muchas actividades con dos llamadas por lote (entregas + calificaciones).
+    
+    Retorna {assignment_id: {userid: estado}} con las mismas claves que obtener_estado_submission
+    (sin feedback). Las actividades que no se pudieron resolver en lote no aparecen.
+    """
+    entregas = {}
+    for lote in dividir_en_lotes(list(dict.fromkeys(int(a) for a in assignment_ids)), tamano_lote):
+        try:
+            submissions_lote = _obtener_submissions_lote_ws(lote)
+            grades_lote = _obtener_grades_detalle_lote_ws(lote)
+        except Exception as e:
+            print(f"Error obteniendo entregas del lote {lote}: {e}")
+            continue
+        
+        for assignment_id, submissions in submissions_lote.items():
+            grades = grades_lote.get(assignment_id, {})
+            estados = {}
+            for user_id in set(submissions) | set(grades):
+                submission = submissions.get(user_id, {})
+                grade = grades.get(user_id, {})
+                try:
+                    calificado = float(grade.get("grade")) >= 0
+                except (TypeError, ValueError):
+                    calificado = False
+                estados[user_id] = {
+                    "submission_timestamp": submission.get("timemodified"),
+                    "grading_timestamp": grade.get("timemodified") if calificado else None,
+                    "submission_status": submission.get("status", ""),
+                }
+            entregas[assignment_id] = estados
+    return entregas
 
-def extraer_fechas_entregas_masivo(actividades_df, progreso_callback=None):
-    """Extrae fechas de entrega y calificación para múltiples actividades"""
+def extraer_fechas_entregas_masivo(actividades_df, progreso_callback=None, usar_lote=True):
+    """Extrae fechas de entrega y calificación para múltiples actividades.
+    
+    Con usar_lote, las fechas se obtienen con mod_assign_get_submissions y mod_assign_get_grades
+    para muchas actividades a la vez; solo se consulta estudiante por estudiante cuando una
+    actividad no se pudo resolver en lote.
+    """
     registros = []
     total_actividades = len(actividades_df)
+    entregas_lote = obtener_entregas_lote(actividades_df['id'].tolist()) if usar_lote and total_actividades else {}
+    precargar_indice_cursos(actividades_df['id_curso'].unique().tolist())
     
     for i, (_, actividad) in enumerate(actividades_df.iterrows()):
         if progreso_callback:
@@ -1974,31 +4216,24 @@ def extraer_fechas_entregas_masivo(actividades_df, progreso_callback=None):
         try:
             assignment_id = actividad['id']
             course_id = actividad['id_curso']
+            estados_actividad = entregas_lote.get(int(assignment_id))
             
             # Obtener participantes
-            participantes = obtener_ids_participantes(assignment_id)
+            participantes = obtener_ids_participantes(assignment_id, course_id)
             
             for participante in participantes:
                 user_id = participante["id"]
                 user_fullname = participante["fullname"]
                 
                 try:
-                    # Obtener estado de entrega
-                    data = obtener_estado_entrega(assignment_id, user_id)
-                    
-                    # Extraer fechas de envío y calificación
-                    sub_ts = (data.get("lastattempt", {})
-                                 .get("submission", {})
-                                 .get("timemodified"))
-                    
-                    grade_ts = (data.get("lastattempt", {}).get("gradeddate")
-                               or data.get("feedback", {})
-                                      .get("grade", {})
-                                      .get("timemodified"))
-                    
-                    # Obtener información adicional
-                    submission_status = data.get("lastattempt", {}).get("submission", {}).get("status", "")
-                    submission_plugins = data.get("lastattempt", {}).get("submission", {}).get("plugins", [])
+                    if estados_actividad is not None:
+                        estado = estados_actividad.get(user_id, {})
+                    else:
+                        # Estado de entrega compartido con las pestañas de feedback
+                        estado = obtener_estado_submission(assignment_id, user_id)
+                    sub_ts = estado.get("submission_timestamp")
+                    grade_ts = estado.get("grading_timestamp")
+                    submission_status = estado.get("submission_status", "")
                     
                     registros.append({
                         "assignment_id": assignment_id,
@@ -2103,7 +4338,12 @@ def mostrar_pestana_fechas_actividades():
                 cursos_unicos = df_actividades_fechas[['id_curso', 'NomCurso', 'Modalidad']].drop_duplicates()
                 
                 total_cursos = len(cursos_unicos)
-                curso_procesado = 0
+                
+                # Una consulta por lote de cursos en lugar de una por curso
+                assignments_por_curso = obtener_indice_assignments().cargar_cursos(
+                    cursos_unicos['id_curso'].tolist(),
+                    progreso_callback=progress_bar.progress
+                )
                 
                 for _, curso_row in cursos_unicos.iterrows():
                     try:
@@ -2111,8 +4351,7 @@ def mostrar_pestana_fechas_actividades():
                         curso_nombre = curso_row['NomCurso']
                         modalidad_curso = curso_row['Modalidad']
                         
-                        # Usar la función verificada para obtener todas las assignments del curso
-                        assignments = obtener_assignments_curso(course_id)
+                        assignments = assignments_por_curso.get(course_id, [])
                         
                         # Obtener información adicional de las actividades del curso en df_actividades_fechas
                         actividades_curso = df_actividades_fechas[df_actividades_fechas['id_curso'] == course_id]
@@ -2149,13 +4388,8 @@ def mostrar_pestana_fechas_actividades():
                             }
                             fechas_actividades.append(fecha_info)
                         
-                        curso_procesado += 1
-                        progress_bar.progress(curso_procesado / total_cursos)
-                        
                     except Exception as e:
                         st.warning(f"Error extrayendo fechas del curso {curso_row['NomCurso']}: {e}")
-                        curso_procesado += 1
-                        progress_bar.progress(curso_procesado / total_cursos)
                 
                 if fechas_actividades:
                     df_fechas_act = pd.DataFrame(fechas_actividades)
@@ -2455,11 +4689,11 @@ def main():
            
         2. **📋 Cache Local Individual**
            - Consultas específicas (curso + actividad)
-           - Almacenado en CSV local
+           - Almacenado en SQLite local
            
         3. **📊 Cache Local Masivo**
            - Consultas masivas (múltiples actividades)
-           - Optimizado para extracciones grandes
+           - Una entrada por actividad, compartida entre selecciones
            
         **⚡ Beneficios:**
         - Reduce tiempo de carga de 30s a 2s
@@ -2467,47 +4701,26 @@ def main():
         - Funciona offline después de la primera carga
         """)
     
-    # Cache individual
-    cache_individual_existe = os.path.exists(CACHE_CSV)
-    if cache_individual_existe:
-        try:
-            cache_df = pd.read_csv(CACHE_CSV)
-            if not cache_df.empty:
-                consultas_individuales = len(cache_df.groupby('cache_key'))
-                registros_individuales = len(cache_df)
-                st.sidebar.success(f"📋 Cache Individual: {consultas_individuales} consultas ({registros_individuales:,} registros)")
-                
-                # Mostrar última actualización si existe timestamp
-                if 'timestamp' in cache_df.columns:
-                    ultima_actualizacion = pd.to_datetime(cache_df['timestamp']).max()
-                    st.sidebar.caption(f"Última actualización: {ultima_actualizacion.strftime('%d/%m/%Y %H:%M')}")
-            else:
-                st.sidebar.info("📋 Cache Individual: Vacío")
-        except Exception as e:
-            st.sidebar.error(f"Error al leer cache individual: {str(e)}")
-    else:
-        st.sidebar.info("📋 Cache Individual: No inicializado")
+    # Cache local (se lee del manifiesto, sin recorrer los datos)
+    stats_individual = {"registros": 0}
+    stats_masivo = {"registros": 0}
+    try:
+        cache_local = obtener_cache_local()
+        stats_individual = cache_local.estadisticas('individual')
+        stats_masivo = cache_local.estadisticas('masivo')
+    except Exception as e:
+        st.sidebar.error(f"Error al leer cache local: {str(e)}")
     
-    # Cache masivo
-    cache_masivo_existe = os.path.exists(CACHE_MASIVO_CSV)
-    if cache_masivo_existe:
-        try:
-            cache_masivo_df = pd.read_csv(CACHE_MASIVO_CSV)
-            if not cache_masivo_df.empty:
-                consultas_masivas = len(cache_masivo_df.groupby('cache_key'))
-                registros_masivos = len(cache_masivo_df)
-                st.sidebar.success(f"📊 Cache Masivo: {consultas_masivas} consultas ({registros_masivos:,} registros)")
-                
-                # Mostrar última actualización si existe timestamp
-                if 'timestamp' in cache_masivo_df.columns:
-                    ultima_actualizacion = pd.to_datetime(cache_masivo_df['timestamp']).max()
-                    st.sidebar.caption(f"Última actualización: {ultima_actualizacion.strftime('%d/%m/%Y %H:%M')}")
-            else:
-                st.sidebar.info("📊 Cache Masivo: Vacío")
-        except Exception as e:
-            st.sidebar.error(f"Error al leer cache masivo: {str(e)}")
-    else:
-        st.sidebar.info("📊 Cache Masivo: No inicializado")
+    for icono, nombre, stats in (("📋", "Cache Individual", stats_individual), ("📊", "Cache Masivo", stats_masivo)):
+        if stats["registros"]:
+            st.sidebar.success(f"{icono} {nombre}: {stats['consultas']} actividades ({stats['registros']:,} registros)")
+            ultima_actualizacion = pd.to_datetime(stats['ultima'])
+            st.sidebar.caption(f"Última actualización: {ultima_actualizacion.strftime('%d/%m/%Y %H:%M')}")
+        else:
+            st.sidebar.info(f"{icono} {nombre}: Vacío")
+    
+    cache_individual_existe = stats_individual["registros"] > 0
+    cache_masivo_existe = stats_masivo["registros"] > 0
     
     # Botones de limpieza
     col1, col2 = st.sidebar.columns(2)
@@ -2515,7 +4728,7 @@ def main():
     with col1:
         if cache_individual_existe and st.button("🗑️ Limpiar Individual", help="Elimina el cache de consultas individuales"):
             try:
-                os.remove(CACHE_CSV)
+                obtener_cache_local().limpiar('individual')
                 st.sidebar.success("Cache individual limpiado")
                 st.rerun()
             except Exception as e:
@@ -2524,24 +4737,48 @@ def main():
     with col2:
         if cache_masivo_existe and st.button("🗑️ Limpiar Masivo", help="Elimina el cache de consultas masivas"):
             try:
-                os.remove(CACHE_MASIVO_CSV)
+                obtener_cache_local().limpiar('masivo')
                 st.sidebar.success("Cache masivo limpiado")
                 st.rerun()
             except Exception as e:
                 st.sidebar.error(f"Error: {str(e)}")
     
+    # Cache de respuestas de Moodle
+    if WS_CACHE_ENABLED:
+        try:
+            stats_ws = obtener_cache_ws().estadisticas()
+            st.sidebar.info(f"🌐 Respuestas Moodle: {stats_ws['entradas']:,} en cache ({stats_ws['mb']:.1f} MB)")
+            if stats_ws['entradas'] and st.sidebar.button("🗑️ Limpiar Respuestas Moodle", help="Elimina las respuestas de Moodle guardadas en disco"):
+                obtener_cache_ws().limpiar()
+                st.sidebar.success("Cache de respuestas limpiado")
+                st.rerun()
+        except Exception as e:
+            st.sidebar.error(f"Error al leer cache de respuestas: {str(e)}")
+    
+    # Aciertos por nivel de cache
+    try:
+        totales = obtener_contadores_cache().totales()
+        niveles = {"supabase": "Supabase", "local": "Local", "moodle_ws": "Respuestas Moodle"}
+        lineas = []
+        for nivel, nombre in niveles.items():
+            aciertos, fallos = totales.get(nivel, (0, 0))
+            if aciertos + fallos:
+                lineas.append(f"{nombre}: {aciertos / (aciertos + fallos):.0%} ({aciertos:,}/{aciertos + fallos:,})")
+        if lineas:
+            st.sidebar.caption("🎯 Aciertos de cache — " + " · ".join(lineas))
+    except Exception as e:
+        st.sidebar.error(f"Error al leer aciertos de cache: {str(e)}")
+    
+    if METRICAS_HABILITADAS:
+        mostrar_panel_metricas()
+    
     # Botón para limpiar todo
     if cache_individual_existe or cache_masivo_existe:
         if st.sidebar.button("🧹 Limpiar Todo el Cache", type="secondary"):
             try:
-                files_removed = 0
-                if cache_individual_existe:
-                    os.remove(CACHE_CSV)
-                    files_removed += 1
-                if cache_masivo_existe:
-                    os.remove(CACHE_MASIVO_CSV)
-                    files_removed += 1
-                st.sidebar.success(f"✅ {files_removed} archivo(s) de cache eliminados")
+                obtener_cache_local().limpiar()
+                registros_eliminados = stats_individual["registros"] + stats_masivo["registros"]
+                st.sidebar.success(f"✅ {registros_eliminados:,} registros de cache eliminados")
                 st.rerun()
             except Exception as e:
                 st.sidebar.error(f"Error al limpiar cache: {str(e)}")
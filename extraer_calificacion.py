@@ -7,6 +7,8 @@
 import requests
 import csv
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ==========================
 # CONFIGURACIÓN INICIAL
@@ -26,13 +28,36 @@ INCLUDE_ENROL   = 1        # 1 = solo usuarios matriculados
 # Guardar el CSV en el directorio actual
 CSV_PATH = "feedback.csv"
 
+# Conexiones HTTP
+POOL_SIZE       = 10       # conexiones keep-alive reutilizables
+TIMEOUT         = (10, 60) # (conexión, lectura) en segundos
+
+# Reintentos ante errores de conexión y 429/5xx con backoff exponencial (respeta Retry-After).
+# A diferencia de la app no hay jitter, tasa adaptativa ni pausa por errores repetidos.
+# Se reintentan también los POST porque todas las funciones WS de este script solo leen.
+# raise_on_status=False entrega la última respuesta, así raise_for_status() sigue lanzando
+# HTTPError en vez de RetryError.
+RETRY = Retry(
+    total=4,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=None,  # None = reintentar también POST
+    raise_on_status=False
+)
+
+# Sesión compartida: evita un handshake TCP+TLS por cada llamada
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=POOL_SIZE, pool_block=True, max_retries=RETRY))
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=POOL_SIZE, pool_block=True, max_retries=RETRY))
+
 
 def llamar_ws(params: dict) -> dict:
     """
     Envía la petición POST al endpoint REST de Moodle y devuelve el JSON decodificado.
     Lanza excepción si hay un error HTTP.
     """
-    resp = requests.post(MOODLE_BASE_URL, data=params, headers=HEADERS, verify=True)
+    resp = SESSION.post(MOODLE_BASE_URL, data=params, verify=True, timeout=TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 